@@ -1,34 +1,101 @@
 import os
+import json
+import time
+import itertools
 import random
 import pickle
+import hashlib
 import numpy as np
 import torch 
 import scipy.io
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+class Documents:
+    """Per-document arrays of word ids (or of their counts) backed by flat CSR arrays, which can be memory-mapped.
+    A split of several shards keeps each shard's (indptr, values) as they are, first gives the id of the first document of each."""
+    def __init__(self, shards):
+        self.shards = shards
+        self.first = np.cumsum([0] + [len(indptr) - 1 for indptr, _ in shards])
+
+    def __len__(self):
+        return int(self.first[-1])
+
+    def __getitem__(self, i):
+        s = np.searchsorted(self.first, i, side='right') - 1
+        indptr, values = self.shards[s]
+        i -= self.first[s]
+        return values[indptr[i]:indptr[i+1]]
+
+    def lengths(self):
+        """Number of non-zero entries of each document."""
+        return np.concatenate([np.diff(np.asarray(indptr, dtype=np.int64)) for indptr, _ in self.shards])
+
+    def nnz(self):
+        return int(sum(indptr[-1] for indptr, _ in self.shards))
+
+    def flat(self):
+        """(indptr, values) of the whole split, joined in memory when there are several shards."""
+        if len(self.shards) == 1:
+            return self.shards[0]
+        offsets = np.cumsum([0] + [indptr[-1] for indptr, _ in self.shards[:-1]])
+        indptr = np.concatenate([[0]] + [indptr[1:] + o for (indptr, _), o in zip(self.shards, offsets)])
+        return indptr, np.concatenate([values for _, values in self.shards])
+
+def _load_mat(prefix):
+    tokens = scipy.io.loadmat(prefix + '_tokens.mat')['tokens'].ravel()
+    counts = scipy.io.loadmat(prefix + '_counts.mat')['counts'].ravel()
+    indptr = np.concatenate([[0], np.cumsum([doc.size for doc in tokens])]).astype(np.int64)
+    if indptr[-1] == 0:
+        return indptr, np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+    return indptr, np.concatenate([doc.ravel() for doc in tokens]), np.concatenate([doc.ravel() for doc in counts])
+
+def _load_npy(prefix):
+    return (np.load(prefix + '_indptr.npy', mmap_mode='r'), 
+                np.load(prefix + '_indices.npy', mmap_mode='r'), 
+                    np.load(prefix + '_counts.npy', mmap_mode='r'))
+
+def _shards(path, split):
+    """Shards of a split, either from manifest.json or the single legacy .mat file."""
+    manifest_file = os.path.join(path, 'manifest.json')
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        return manifest['splits'][split]
+    return [{'file': f'bow_{split}', 'format': 'mat'}]
+
+def load_split(path, split):
+    """Returns the tokens and counts of a split ('tr', 'va', 'ts', 'ts_h1' or 'ts_h2').
+    The .npy shards are memory-mapped, each one separately."""
+    tokens = []
+    counts = []
+    for shard in _shards(path, split):
+        prefix = os.path.join(path, shard['file'])
+        indptr, indices, values = _load_mat(prefix) if shard.get('format', 'mat') == 'mat' else _load_npy(prefix)
+        tokens.append((indptr, indices))
+        counts.append((indptr, values))
+    return Documents(tokens), Documents(counts)
+
+def load_weights(path, split, tokens):
+    """Multiplicities of documents which stand for collapsed near-duplicates, None if the split has none.
+    The shards without weights (e.g., the .mat files of a legacy dataset) count each of their tokens documents once."""
+    shards = _shards(path, split)
+    if not any('weights' in shard for shard in shards):
+        return None
+    return np.concatenate([np.load(os.path.join(path, shard['file'] + '_weights.npy')) if 'weights' in shard 
+                               else np.ones(n, dtype=np.uint8) for shard, n in zip(shards, np.diff(tokens.first))])
 
 def _fetch(path, name):
-    if name == 'train':
-        token_file = os.path.join(path, 'bow_tr_tokens.mat')
-        count_file = os.path.join(path, 'bow_tr_counts.mat')
-    elif name == 'valid':
-        token_file = os.path.join(path, 'bow_va_tokens.mat')
-        count_file = os.path.join(path, 'bow_va_counts.mat')
-    else:
-        token_file = os.path.join(path, 'bow_ts_tokens.mat')
-        count_file = os.path.join(path, 'bow_ts_counts.mat')
-    tokens = scipy.io.loadmat(token_file)['tokens'].squeeze()
-    counts = scipy.io.loadmat(count_file)['counts'].squeeze()
+    split = {'train': 'tr', 'valid': 'va'}.get(name, 'ts')
+    tokens, counts = load_split(path, split)
     if name == 'test':
-        token_1_file = os.path.join(path, 'bow_ts_h1_tokens.mat')
-        count_1_file = os.path.join(path, 'bow_ts_h1_counts.mat')
-        token_2_file = os.path.join(path, 'bow_ts_h2_tokens.mat')
-        count_2_file = os.path.join(path, 'bow_ts_h2_counts.mat')
-        tokens_1 = scipy.io.loadmat(token_1_file)['tokens'].squeeze()
-        counts_1 = scipy.io.loadmat(count_1_file)['counts'].squeeze()
-        tokens_2 = scipy.io.loadmat(token_2_file)['tokens'].squeeze()
-        counts_2 = scipy.io.loadmat(count_2_file)['counts'].squeeze()
+        tokens_1, counts_1 = load_split(path, 'ts_h1')
+        tokens_2, counts_2 = load_split(path, 'ts_h2')
         return {'tokens': tokens, 'counts': counts, 
                     'tokens_1': tokens_1, 'counts_1': counts_1, 
                         'tokens_2': tokens_2, 'counts_2': counts_2}
+    if name == 'train':
+        return {'tokens': tokens, 'counts': counts, 'weights': load_weights(path, split, tokens)}
     return {'tokens': tokens, 'counts': counts}
 
 def get_data(path):
@@ -41,23 +108,232 @@ def get_data(path):
 
     return vocab, train, valid, test
 
-def get_batch(tokens, counts, ind, vocab_size, device, emsize=300):
-    """fetch input data by batch."""
-    batch_size = len(ind)
-    data_batch = np.zeros((batch_size, vocab_size))
-    
-    for i, doc_id in enumerate(ind):
-        doc = tokens[doc_id]
-        count = counts[doc_id]
-        L = count.shape[1]
-        if len(doc) == 1: 
-            doc = [doc.squeeze()]
-            count = [count.squeeze()]
-        else:
-            doc = doc.squeeze()
-            count = count.squeeze()
-        if doc_id != -1:
-            for j, word in enumerate(doc):
-                data_batch[i, word] = count[j]
-    data_batch = torch.from_numpy(data_batch).float().to(device)
+def _embeddings_hash(emb_path, vocab, emsize):
+    stat = os.stat(emb_path)
+    source = f'{os.path.abspath(emb_path)}\t{stat.st_size}\t{stat.st_mtime_ns}\t{emsize}\n'
+    return hashlib.sha1((source + '\n'.join(vocab)).encode('utf-8')).hexdigest()
+
+def load_embeddings(emb_path, vocab, emsize, cache_dir):
+    """V x emsize float32 vectors of the words in vocab from a text file of word embeddings and the mask of the words not found there.
+    They are cached in cache_dir as embeddings.npy and embeddings_oov.npy, which are memory-mapped by the next runs,
+    while embeddings.json keeps the hash of the vocabulary and of the source file, so that a change in either rebuilds the cache."""
+    emb_hash = _embeddings_hash(emb_path, vocab, emsize)
+    meta_file = os.path.join(cache_dir, 'embeddings.json')
+    vectors_file = os.path.join(cache_dir, 'embeddings.npy')
+    oov_file = os.path.join(cache_dir, 'embeddings_oov.npy')
+    if os.path.isfile(meta_file):
+        with open(meta_file) as f:
+            if json.load(f).get('hash') == emb_hash:
+                return np.load(vectors_file, mmap_mode='r'), np.load(oov_file)
+    word2id = {w: i for i, w in enumerate(vocab)}
+    vectors = np.zeros((len(vocab), emsize), dtype=np.float32)
+    oov = np.ones(len(vocab), dtype=bool)
+    with open(emb_path, 'rb') as f:
+        for l in f:
+            line = l.decode('utf-8', errors='replace').rstrip().split(' ')
+            i = word2id.get(line[0])
+            if i is not None and len(line) == emsize + 1:
+                vectors[i] = np.asarray(line[1:], dtype=np.float32)
+                oov[i] = False
+    np.save(vectors_file, vectors)
+    np.save(oov_file, oov)
+    with open(meta_file, 'w') as f:
+        json.dump({'hash': emb_hash, 'source': os.path.abspath(emb_path), 'emsize': emsize, 
+                       'found': int((~oov).sum()), 'vocab_size': len(vocab)}, f, indent=1)
+    return np.load(vectors_file, mmap_mode='r'), oov
+
+def gather(tokens, counts, ind):
+    """Flat arrays of batch rows, word ids and counts of the documents ind, read directly from the CSR arrays of their shards."""
+    ind = np.asarray(ind, dtype=np.int64)
+    shard_of = np.searchsorted(tokens.first, ind, side='right') - 1
+    parts = []
+    for s in np.unique(shard_of):
+        batch_rows = np.nonzero(shard_of == s)[0]
+        indptr, words = tokens.shards[s]
+        local = ind[batch_rows] - tokens.first[s]
+        starts = np.asarray(indptr[local], dtype=np.int64)
+        lengths = np.asarray(indptr[local+1], dtype=np.int64) - starts
+        offsets = np.cumsum(lengths) - lengths
+        positions = np.arange(lengths.sum()) + np.repeat(starts - offsets, lengths)
+        parts.append((np.repeat(batch_rows, lengths), words[positions], counts.shards[s][1][positions]))
+    if len(parts) == 1:
+        rows, words, values = parts[0]
+    else: # back in the order of ind
+        rows, words, values = [np.concatenate(a) for a in zip(*parts)]
+        order = np.argsort(rows, kind='stable')
+        rows, words, values = rows[order], words[order], values[order]
+    return rows, words.astype(np.int64), values.astype(np.float32)
+
+# A batch of documents as flat (word id, count) pairs without the bsz x V matrix:
+# document i has the pairs from offsets[i] to offsets[i+1], rows gives the document of each pair
+SparseBatch = namedtuple('SparseBatch', ['rows', 'words', 'values', 'offsets'])
+
+def get_batch(tokens, counts, ind, vocab_size, device, emsize=300, sparse=False, pin_memory=False):
+    """fetch input data by batch: a float32 bsz x V tensor filled by one scatter on the device, or a SparseBatch."""
+    rows, words, values = gather(tokens, counts, ind)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=len(ind)))])
+    rows, words, values, offsets = [torch.from_numpy(a) for a in (rows, words, values, offsets)]
+    if pin_memory: # asynchronous copies to the GPU
+        rows, words, values, offsets = rows.pin_memory(), words.pin_memory(), values.pin_memory(), offsets.pin_memory()
+    rows = rows.to(device, non_blocking=pin_memory)
+    words = words.to(device, non_blocking=pin_memory)
+    values = values.to(device, non_blocking=pin_memory)
+    if sparse:
+        return SparseBatch(rows, words, values, offsets.to(device, non_blocking=pin_memory))
+    data_batch = torch.zeros(len(ind), vocab_size, device=device)
+    data_batch[rows, words] = values
     return data_batch
+
+def token_batches(tokens, budget, generator=None):
+    """Splits the documents into batches of similar length with up to budget non-zero counts in each (or a single longer document).
+    The documents are shuffled before a stable sort by length, so that the batches differ between epochs,
+    then the batches are shuffled across the lengths.  Both use the torch generator, which follows --seed."""
+    lengths = tokens.lengths()
+    perm = torch.randperm(len(lengths), generator=generator).numpy()
+    order = perm[np.argsort(lengths[perm], kind='stable')]
+    cum = np.cumsum(lengths[order])
+    batches = []
+    start = 0
+    while start < len(order):
+        base = cum[start-1] if start > 0 else 0
+        end = max(start+1, np.searchsorted(cum, base + budget, side='right'))
+        batches.append(torch.from_numpy(order[start:end]))
+        start = end
+    return [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+
+def row_sums(data_batch):
+    """Number of tokens in each document of a dense or sparse batch."""
+    if isinstance(data_batch, SparseBatch):
+        sums = torch.zeros(len(data_batch.offsets)-1, device=data_batch.values.device)
+        return sums.index_add_(0, data_batch.rows, data_batch.values)
+    return data_batch.sum(1)
+
+def nan_empty(batch):
+    """Gives each empty document of a normalised SparseBatch a single NaN entry, as 0/0 fills its row in the dense path,
+    so that its theta is NaN as well and apply prints no topics for it."""
+    empty = batch.offsets[1:] == batch.offsets[:-1]
+    if not empty.any():
+        return batch
+    docs = empty.nonzero().squeeze(1)
+    rows, order = torch.sort(torch.cat([batch.rows, docs]), stable=True)
+    words = torch.cat([batch.words, torch.zeros_like(docs)])[order]
+    values = torch.cat([batch.values, torch.full(docs.shape, float('nan'), device=docs.device)])[order]
+    offsets = batch.offsets + torch.cat([torch.zeros(1, dtype=docs.dtype, device=docs.device), torch.cumsum(empty, 0)])
+    return SparseBatch(rows, words, values, offsets)
+
+def normalize(data_batch):
+    if isinstance(data_batch, SparseBatch):
+        return nan_empty(data_batch._replace(values=data_batch.values / row_sums(data_batch)[data_batch.rows]))
+    return data_batch / data_batch.sum(1).unsqueeze(1)
+
+class DeviceDataset:
+    """A whole split as flat CSR tensors on the device with the counts and the counts divided by the document lengths,
+    both computed once, so that a batch is an index selection and a scatter on the device."""
+    def __init__(self, tokens, counts, vocab_size, device, bow_norm=True):
+        self.vocab_size = vocab_size
+        self.device = torch.device(device)
+        self.bow_norm = bow_norm
+        indptr, words = tokens.flat()
+        indptr = np.asarray(indptr, dtype=np.int64)
+        self.indptr = torch.from_numpy(indptr).to(self.device)
+        self.words = torch.from_numpy(np.asarray(words, dtype=np.int64)).to(self.device)
+        self.values = torch.from_numpy(np.asarray(counts.flat()[1], dtype=np.float32)).to(self.device)
+        lengths = torch.from_numpy(np.diff(indptr)).to(self.device)
+        sums = torch.zeros(len(lengths), device=self.device).index_add_(
+                   0, torch.repeat_interleave(torch.arange(len(lengths), device=self.device), lengths), self.values)
+        self.normalized_values = self.values / torch.repeat_interleave(sums, lengths) if bow_norm else self.values
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def batch(self, ind, sparse=False):
+        """(ind, data_batch, normalized_data_batch) as from BatchLoader."""
+        ind = ind.to(self.device)
+        starts = self.indptr[ind]
+        lengths = self.indptr[ind+1] - starts
+        offsets = torch.cumsum(lengths, 0) - lengths
+        positions = torch.arange(int(lengths.sum()), device=self.device) + torch.repeat_interleave(starts - offsets, lengths)
+        rows = torch.repeat_interleave(torch.arange(len(ind), device=self.device), lengths)
+        words = self.words[positions]
+        values = self.values[positions]
+        normalized_values = self.normalized_values[positions]
+        if sparse:
+            offsets = torch.cat([offsets, lengths.sum().view(1)])
+            normalized_data_batch = SparseBatch(rows, words, normalized_values, offsets)
+            if self.bow_norm:
+                normalized_data_batch = nan_empty(normalized_data_batch)
+            return ind, SparseBatch(rows, words, values, offsets), normalized_data_batch
+        data_batch = torch.zeros(len(ind), self.vocab_size, device=self.device)
+        data_batch[rows, words] = values
+        if not self.bow_norm:
+            return ind, data_batch, data_batch
+        normalized_data_batch = torch.zeros(len(ind), self.vocab_size, device=self.device)
+        normalized_data_batch[rows, words] = normalized_values
+        return ind, data_batch, normalized_data_batch
+
+class DeviceLoader:
+    """Iterates over the batches of document ids in indices taken from a DeviceDataset, as BatchLoader does."""
+    def __init__(self, dataset, indices, sparse=False):
+        self.dataset = dataset
+        self.indices = indices
+        self.sparse = sparse
+        self.wait = 0.0
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        for ind in self.indices:
+            started = time.time()
+            batch = self.dataset.batch(ind, self.sparse)
+            self.wait += time.time() - started
+            yield batch
+
+class BatchLoader:
+    """Iterates over (ind, data_batch, normalized_data_batch) for the batches of document ids in indices.
+    The next prefetch batches are built in background threads while the model works on the current one,
+    they come in the order of indices, so the order stays deterministic for a given seed.
+    wait accumulates the time the caller has been waiting for input.
+    With sparse the batches are SparseBatch tuples instead of dense bsz x V tensors."""
+    def __init__(self, tokens, counts, indices, vocab_size, device, bow_norm=True, prefetch=2, workers=1, sparse=False):
+        self.tokens = tokens
+        self.counts = counts
+        self.indices = indices
+        self.vocab_size = vocab_size
+        self.device = torch.device(device)
+        self.bow_norm = bow_norm
+        self.prefetch = prefetch
+        self.workers = workers
+        self.sparse = sparse
+        self.wait = 0.0
+
+    def __len__(self):
+        return len(self.indices)
+
+    def _build(self, ind):
+        data_batch = get_batch(self.tokens, self.counts, ind, self.vocab_size, self.device, 
+                                   sparse=self.sparse, pin_memory=self.device.type == 'cuda')
+        if self.bow_norm:
+            normalized_data_batch = normalize(data_batch)
+        else:
+            normalized_data_batch = data_batch
+        return ind, data_batch, normalized_data_batch
+
+    def __iter__(self):
+        if self.prefetch <= 0:
+            for ind in self.indices:
+                started = time.time()
+                batch = self._build(ind)
+                self.wait += time.time() - started
+                yield batch
+            return
+        with ThreadPoolExecutor(self.workers) as pool:
+            todo = iter(self.indices)
+            pending = deque(pool.submit(self._build, ind) for ind in itertools.islice(todo, self.prefetch))
+            while pending:
+                started = time.time()
+                batch = pending.popleft().result()
+                self.wait += time.time() - started
+                for ind in itertools.islice(todo, 1):
+                    pending.append(pool.submit(self._build, ind))
+                yield batch
@@ -2,6 +2,10 @@ import torch
 import torch.nn.functional as F 
 import numpy as np 
 import math 
+import json
+import io
+import pickle
+import hashlib
 
 from torch import nn
 
@@ -81,49 +85,269 @@ class ETM(nn.Module):
 
         input: bows
                 batch of bag-of-words...tensor of shape bsz x V
+                or (rows, words, values, offsets) of its non-zero entries
         output: mu_theta, log_sigma_theta
         """
-        q_theta = self.q_theta(bows)
+        if isinstance(bows, torch.Tensor):
+            q_theta = self.q_theta(bows)
+        else: # the first layer as a weighted bag of its columns, the cost is in the number of tokens, not in bsz x V
+            first = self.q_theta[0]
+            hidden = F.embedding_bag(bows.words, first.weight.t(), bows.offsets[:-1], 
+                                         mode='sum', per_sample_weights=bows.values) + first.bias
+            q_theta = self.q_theta[1:](hidden)
         if self.enc_drop > 0:
             q_theta = self.t_drop(q_theta)
-        mu_theta = self.mu_q_theta(q_theta)
-        logsigma_theta = self.logsigma_q_theta(q_theta)
-        kl_theta = -0.5 * torch.sum(1 + logsigma_theta - mu_theta.pow(2) - logsigma_theta.exp(), dim=-1).mean()
+        # under autocast the matmuls may run in bfloat16/float16, the sampling, KL and softmax stay in float32
+        mu_theta = self.mu_q_theta(q_theta).float()
+        logsigma_theta = self.logsigma_q_theta(q_theta).float()
+        kl_theta = -0.5 * torch.sum(1 + logsigma_theta - mu_theta.pow(2) - logsigma_theta.exp(), dim=-1)
         return mu_theta, logsigma_theta, kl_theta
 
-    def get_beta(self):
+    def compute_beta(self):
         try:
             logit = self.alphas(self.rho.weight) # torch.mm(self.rho, self.alphas)
         except:
             logit = self.alphas(self.rho)
-        beta = F.softmax(logit, dim=0).transpose(1, 0) ## softmax over vocab dimension
+        beta = F.softmax(logit.float(), dim=0).transpose(1, 0) ## softmax over vocab dimension
         return beta
 
-    def get_theta(self, normalized_bows):
+    def param_versions(self):
+        """Changes whenever rho or alphas are updated in place (by an optimizer step or load_state_dict) or replaced."""
+        try:
+            rho = self.rho.weight
+        except:
+            rho = self.rho
+        return tuple((p.data_ptr(), p._version) for p in (self.alphas.weight, rho))
+
+    def get_beta(self):
+        """beta is cached when no gradients are needed, so that eval and apply compute it once per model,
+        while training gets a fresh beta with its graph at each step."""
+        if torch.is_grad_enabled():
+            return self.compute_beta()
+        versions = self.param_versions()
+        cache = getattr(self, 'beta_cache', None)
+        if cache is None or cache[0] != versions:
+            self.beta_cache = (versions, self.compute_beta(), {})
+        return self.beta_cache[1]
+
+    def top_words(self, k):
+        """K x k ids of the most probable words of each topic in the decreasing order, cached with beta."""
+        with torch.no_grad():
+            beta = self.get_beta()
+            top = self.beta_cache[2]
+            if k not in top:
+                longer = [n for n in top if n >= k]
+                if longer: # the top words of a longer list
+                    top[k] = top[min(longer)][:, :k]
+                else:
+                    top[k] = beta.topk(min(k, beta.shape[1]), dim=1).indices
+            return top[k]
+
+    def __getstate__(self):
+        # the cache is not saved with the model
+        state = self.__dict__.copy()
+        state.pop('beta_cache', None)
+        return state
+
+    def get_theta(self, normalized_bows, weights=None):
         mu_theta, logsigma_theta, kld_theta = self.encode(normalized_bows)
         z = self.reparameterize(mu_theta, logsigma_theta)
         theta = F.softmax(z, dim=-1) 
-        return theta, kld_theta
+        return theta, weighted_mean(kld_theta, weights)
 
     def decode(self, theta, beta):
-        res = torch.mm(theta, beta)
+        res = torch.mm(theta, beta).float()
         preds = torch.log(res+1e-6)
         return preds 
 
-    def forward(self, bows, normalized_bows, theta=None, aggregate=True):
+    def decode_sparse(self, theta, beta, bows, eps=1e-6):
+        """Log-likelihood of each document given as (rows, words, values, offsets).
+        Only the columns of beta for the observed words are used, so the cost is nnz x K instead of bsz x V x K.
+        """
+        res = (theta[bows.rows] * beta.t()[bows.words]).sum(1)
+        loglik = torch.zeros(theta.shape[0], device=theta.device)
+        return loglik.index_add_(0, bows.rows, bows.values * torch.log(res+eps))
+
+    def decode_sampled(self, theta, bows, sampler):
+        """Log-likelihood of each document with the softmax over the vocabulary approximated by the words of the batch
+        and the negatives drawn from the sampler, so that the cost does not depend on V.
+        The sampled words are corrected by the log-probability of their inclusion in the sample (as in sampled softmax).
+        """
+        negatives = sampler.sample()
+        words, positions = torch.unique(torch.cat([bows.words, negatives]), return_inverse=True)
+        positions = positions[:len(bows.words)]
+        observed = torch.zeros(len(words), dtype=torch.bool, device=words.device)
+        observed[positions] = True
+        correction = torch.where(observed, torch.zeros_like(sampler.log_inclusion[words]), sampler.log_inclusion[words])
+        try:
+            rho = self.rho.weight[words]
+        except:
+            rho = self.rho[words]
+        logit = self.alphas(rho).float() - correction.unsqueeze(1)
+        beta = F.softmax(logit, dim=0).transpose(1, 0) ## softmax over the candidate words
+        return self.decode_sparse(theta, beta, bows._replace(words=positions))
+
+    def forward(self, bows, normalized_bows, theta=None, aggregate=True, weights=None, sampler=None):
         ## get \theta
         if theta is None:
-            theta, kld_theta = self.get_theta(normalized_bows)
+            theta, kld_theta = self.get_theta(normalized_bows, weights)
         else:
             kld_theta = None
 
+        ## get prediction loss
+        if sampler is not None:
+            recon_loss = -self.decode_sampled(theta, bows, sampler)
+            if aggregate:
+                recon_loss = weighted_mean(recon_loss, weights)
+            return recon_loss, kld_theta
+
         ## get \beta
         beta = self.get_beta()
 
-        ## get prediction loss
-        preds = self.decode(theta, beta)
-        recon_loss = -(preds * bows).sum(1)
+        if isinstance(bows, torch.Tensor):
+            preds = self.decode(theta, beta)
+            recon_loss = -(preds * bows).sum(1)
+        else:
+            recon_loss = -self.decode_sparse(theta, beta, bows)
         if aggregate:
-            recon_loss = recon_loss.mean()
+            recon_loss = weighted_mean(recon_loss, weights)
         return recon_loss, kld_theta
 
+class InferenceModel(nn.Module):
+    """encode -> softmax -> top-k of a trained ETM in the eval mode (theta is the mean of q(theta)), without its decoder."""
+    def __init__(self, model, top_k):
+        super(InferenceModel, self).__init__()
+        self.q_theta = model.q_theta
+        self.mu_q_theta = model.mu_q_theta
+        self.top_k = top_k
+
+    def forward(self, normalized_bows):
+        theta = F.softmax(self.mu_q_theta(self.q_theta(normalized_bows)), dim=-1)
+        values, ids = theta.topk(self.top_k, dim=-1)
+        return theta, values, ids
+
+def export_script(model, batch_size, top_k, fname):
+    """Saves the inference graph traced for batches of batch_size x V as a TorchScript file,
+    which can be used without the ETM class, with its dimensions in meta.json."""
+    model.eval()
+    inference = InferenceModel(model, min(top_k, model.num_topics)).eval()
+    example = torch.zeros(batch_size, model.vocab_size, device=next(model.parameters()).device)
+    with torch.no_grad():
+        scripted = torch.jit.freeze(torch.jit.trace(inference, example))
+    meta = {'vocab_size': model.vocab_size, 'num_topics': model.num_topics, 
+                'batch_size': batch_size, 'top_k': inference.top_k}
+    torch.jit.save(scripted, fname, _extra_files={'meta.json': json.dumps(meta)})
+    return meta
+
+def load_script(fname, device):
+    """The TorchScript inference graph and its meta data from export_script."""
+    extra = {'meta.json': ''}
+    scripted = torch.jit.load(fname, map_location=device, _extra_files=extra)
+    return scripted, json.loads(extra['meta.json'])
+
+def quantize_encoder(model, sparse_input=False):
+    """A copy of the model for CPU inference with the linear layers of the encoder in dynamic int8:
+    int8 weights, with the activations quantised batch by batch.  For sparse input the first layer stays in float32 for embedding_bag."""
+    layers = {'q_theta.2', 'mu_q_theta'} if sparse_input else {'q_theta.0', 'q_theta.2', 'mu_q_theta'}
+    return torch.ao.quantization.quantize_dynamic(model, layers, dtype=torch.qint8)
+
+def encoder_bytes(model):
+    """Size of the saved encoder weights (q_theta and mu_q_theta) used by eval and apply."""
+    buf = io.BytesIO()
+    torch.save({'q_theta': model.q_theta.state_dict(), 'mu_q_theta': model.mu_q_theta.state_dict()}, buf)
+    return buf.tell()
+
+# checkpoints are dictionaries of tensors and plain values with the version of their layout
+BUNDLE_VERSION = 1
+
+def vocab_hash(vocab):
+    return hashlib.sha1('\n'.join(vocab).encode('utf-8')).hexdigest()
+
+def save_bundle(model, fname, hyperparams, vocab, num_words=100):
+    """Saves the state_dict with the hyperparameters to rebuild the model, the hash of its vocabulary,
+    and beta, the num_words top word ids of each topic and the normalised rho, which the reports use without the model."""
+    with torch.no_grad():
+        beta = model.compute_beta().cpu()
+        try:
+            rho = model.rho.weight.detach().cpu()
+        except:
+            rho = model.rho.cpu()
+        bundle = {'format': 'etm', 'version': BUNDLE_VERSION, 'hyperparams': hyperparams, 
+                  'vocab_hash': vocab_hash(vocab), 'state_dict': model.state_dict(), 
+                  'beta': beta, 'top_words': beta.topk(min(num_words, beta.shape[1]), dim=1).indices,
+                  'rho_normalized': rho / rho.norm(dim=1, keepdim=True).clamp(min=1e-12)}
+        if not isinstance(model.rho, nn.Module): # fixed embeddings are not in the state_dict
+            bundle['rho'] = rho
+    torch.save(bundle, fname)
+
+def load_bundle(fname):
+    """The checkpoint with its tensors memory-mapped, so that only the parts in use are read,
+    or None for a pickled ETM module saved by the earlier versions."""
+    try:
+        bundle = torch.load(fname, map_location='cpu', mmap=True, weights_only=True)
+    except (pickle.UnpicklingError, RuntimeError):
+        return None
+    if not isinstance(bundle, dict) or bundle.get('format') != 'etm':
+        return None
+    if bundle['version'] > BUNDLE_VERSION:
+        raise ValueError(f"{fname} has checkpoint version {bundle['version']}, this code reads up to {BUNDLE_VERSION}")
+    return bundle
+
+def model_from_bundle(bundle, device):
+    """The ETM with the parameters of the bundle (without initialising new ones) and its beta cache filled."""
+    hp = bundle['hyperparams']
+    with torch.device('meta'):
+        model = ETM(hp['num_topics'], hp['vocab_size'], hp['t_hidden_size'], hp['rho_size'], hp['emsize'], 
+                        hp['theta_act'], bundle.get('rho'), hp['train_embeddings'], hp['enc_drop'])
+    model.load_state_dict(bundle['state_dict'], assign=True)
+    if 'rho' in bundle: # a plain tensor, which model.to() does not move
+        model.rho = bundle['rho'].to(device)
+    model = model.to(device)
+    model.eval()
+    top_words = bundle['top_words'].to(device)
+    model.beta_cache = (model.param_versions(), bundle['beta'].to(device), {top_words.shape[1]: top_words})
+    return model
+
+def load_model(fname, device):
+    """(model, bundle) from a checkpoint, the bundle is None for the pickled ETM modules."""
+    bundle = load_bundle(fname)
+    if bundle is None:
+        with open(fname, 'rb') as f:
+            model = torch.load(f, map_location=torch.device(device), weights_only=False)
+        model = model.to(device)
+        model.eval()
+        return model, None
+    return model_from_bundle(bundle, device), bundle
+
+def export_npz(model, vocab, bow_norm, fname):
+    """Saves the encoder weights (transposed for x @ w), the vocabulary and the meta data for etm_numpy.py."""
+    layers = [model.q_theta[0], model.q_theta[2], model.mu_q_theta]
+    arrays = {}
+    for i, layer in enumerate(layers):
+        arrays[f'w{i}'] = layer.weight.detach().cpu().float().numpy().T.copy()
+        arrays[f'b{i}'] = layer.bias.detach().cpu().float().numpy()
+    meta = {'vocab_size': model.vocab_size, 'num_topics': model.num_topics, 
+                'theta_act': type(model.theta_act).__name__, 'bow_norm': bool(bow_norm)}
+    np.savez(fname, vocab=np.array(vocab), meta=json.dumps(meta), **arrays)
+    return meta
+
+class NegativeSampler:
+    """Draws num_samples word ids with probabilities proportional to freqs, by a binary search in their cumulative sum.
+    The draws are with replacement and merged into a set, so a word is in the sample with the probability 1-(1-q)^num_samples."""
+    def __init__(self, freqs, num_samples, device):
+        q = torch.as_tensor(freqs, dtype=torch.float64)
+        q = q / q.sum()
+        self.cdf = torch.cumsum(q, 0).float().to(device)
+        self.log_inclusion = torch.log(-torch.expm1(num_samples * torch.log1p(-q.clamp(min=1e-12)))).float().to(device)
+        self.num_samples = num_samples
+
+    def sample(self):
+        u = torch.rand(self.num_samples, device=self.cdf.device) * self.cdf[-1]
+        return torch.searchsorted(self.cdf, u).clamp(max=len(self.cdf)-1)
+
+def weighted_mean(x, weights=None):
+    """Mean over documents, each counted as many times as the near-duplicates it stands for."""
+    if weights is None:
+        return x.mean()
+    return (x * weights).sum() / weights.sum()
+
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Applies an ETM model exported by `main.py --mode export --npz MODEL.npz` with NumPy only,
+# so that short-lived workers start quickly and keep only the encoder weights in memory:
+#   python3 etm_numpy.py MODEL.npz <CORPUS-NEW.ol >CORPUSNEW.topics
+# Each line is a tokenised document, the output is in the same format as from --mode apply
+
+import argparse
+import json
+import sys
+
+import numpy as np
+
+
+def softplus(x):
+    return np.logaddexp(0, x)
+
+def elu(x, alpha=1.0):
+    return np.where(x > 0, x, alpha * np.expm1(np.minimum(x, 0)))
+
+# the activations of ETM.get_activation in the eval mode (rrelu uses the mean of its slopes)
+ACTIVATIONS = {'Tanh': np.tanh,
+               'ReLU': lambda x: np.maximum(x, 0),
+               'Softplus': softplus,
+               'RReLU': lambda x: np.where(x > 0, x, x * (1/8 + 1/3) / 2),
+               'LeakyReLU': lambda x: np.where(x > 0, x, x * 0.01),
+               'ELU': elu,
+               'SELU': lambda x: 1.0507009873554805 * elu(x, 1.6732632423543772)}
+
+
+class NumpyETM:
+    """The encoder of an ETM model: theta is the softmax of the mean of q(theta) as in ETM.get_theta in the eval mode."""
+    def __init__(self, fname):
+        with np.load(fname, allow_pickle=False) as bundle:
+            self.meta = json.loads(str(bundle['meta']))
+            self.weights = [(bundle[f'w{i}'], bundle[f'b{i}']) for i in range(3)]
+            self.vocab = bundle['vocab'].tolist()
+        self.word2id = {w: i for i, w in enumerate(self.vocab)}
+        self.act = ACTIVATIONS[self.meta['theta_act']]
+
+    def encode(self, lines):
+        """CSR arrays (indptr, word ids, counts) of the lines, words outside the vocabulary are ignored."""
+        indptr = [0]
+        words = []
+        counts = []
+        for line in lines:
+            ids, cnt = np.unique([self.word2id[w] for w in line.split() if w in self.word2id], return_counts=True)
+            words.extend(ids)
+            counts.extend(cnt)
+            indptr.append(len(words))
+        return np.array(indptr, dtype=np.int64), np.array(words, dtype=np.int64), np.array(counts, dtype=np.float32)
+
+    def get_theta(self, indptr, words, counts):
+        """bsz x K topic proportions of the documents in the CSR form, the first layer only takes the rows of the observed words."""
+        lengths = np.diff(indptr)
+        if self.meta['bow_norm']:
+            sums = np.add.reduceat(counts, indptr[:-1][lengths > 0]) if len(counts) else counts
+            counts = counts / np.repeat(sums, lengths[lengths > 0])
+        (w0, b0), (w1, b1), (w2, b2) = self.weights
+        hidden = np.zeros((len(lengths), w0.shape[1]), dtype=np.float32)
+        if len(words):
+            hidden[lengths > 0] = np.add.reduceat(w0[words] * counts[:, None], indptr[:-1][lengths > 0])
+        hidden = self.act(self.act(hidden + b0) @ w1 + b1)
+        mu = hidden @ w2 + b2
+        theta = np.exp(mu - mu.max(1, keepdims=True))
+        theta = theta / theta.sum(1, keepdims=True)
+        if self.meta['bow_norm']: # as 0/0 in the normalised bows of main.py
+            theta[lengths == 0] = np.nan
+        return theta
+
+
+def best_topics(theta, top_k, threshold):
+    """(proportion, topic) pairs in the same way as in --mode apply."""
+    out = []
+    lastv = 2.0
+    for t in np.argsort(-theta, kind='stable')[:top_k]:
+        v = float(theta[t])
+        if np.isnan(v):
+            break
+        if threshold > 0 and not (lastv > 1 or v/lastv > threshold):
+            break
+        out.append((float(int(v*1000))/1000, int(t)))
+        lastv = v
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Applies an exported ETM model with NumPy')
+    parser.add_argument('model', help='.npz file from main.py --mode export --npz')
+    parser.add_argument('-c', '--corpusfile', type=str, default='-', help='one document per line, stdin by default')
+    parser.add_argument('-o', '--output', type=str, default='-', help='the name of the output file')
+    parser.add_argument('--batch_size', type=int, default=1000)
+    parser.add_argument('--topK', type=int, default=3, help='max number of topics for predictions')
+    parser.add_argument('--threshold', type=float, default=0.5, help='threshold for printing less significant topics')
+    args = parser.parse_args()
+
+    model = NumpyETM(args.model)
+    # lines end only at '\n' as in scripts/bow_utils.py, so that the output stays aligned with BoW datasets of the same corpus
+    if args.corpusfile == '-':
+        sys.stdin.reconfigure(encoding='utf-8', errors='replace', newline='\n')
+        infile = sys.stdin
+    else:
+        infile = open(args.corpusfile, encoding='utf-8', errors='replace', newline='\n')
+    outfile = sys.stdout if args.output == '-' else open(args.output, 'w')
+    batch = []
+    for line in infile:
+        batch.append(line)
+        if len(batch) == args.batch_size:
+            for theta in model.get_theta(*model.encode(batch)):
+                print(best_topics(theta, args.topK, args.threshold), file=outfile)
+            batch = []
+    if batch:
+        for theta in model.get_theta(*model.encode(batch)):
+            print(best_topics(theta, args.topK, args.threshold), file=outfile)
+    outfile.close()
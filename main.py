@@ -14,17 +14,19 @@ import os
 import math 
 import random 
 import sys
+import contextlib
+import subprocess
 import data
-import scipy.io
 
 from torch import nn, optim
 from torch.nn import functional as F
 
-from etm import ETM
+from etm import ETM, NegativeSampler, export_script, load_script, export_npz, quantize_encoder, encoder_bytes
+from etm import save_bundle, load_bundle, load_model, vocab_hash
 from utils import nearest_neighbors, get_topic_coherence, get_topic_diversity
 
 parser = argparse.ArgumentParser(description='The Embedded Topic Model')
-parser.add_argument('--mode', type=str, default='train', help='train, eval or apply model')
+parser.add_argument('--mode', type=str, default='train', help='train, eval or apply model, export it for apply, or report its topics')
 
 ### data and file related arguments
 parser.add_argument('--dataset', type=str, default='20ng', help='dataset name')
@@ -45,6 +47,8 @@ parser.add_argument('--train_embeddings', type=int, default=1, help='whether to
 
 ### optimization-related arguments
 parser.add_argument('--batch_size', type=int, default=1000, help='input batch size for training')
+parser.add_argument('--batching', type=str, default='docs', help='docs for batches of --batch_size documents, tokens for batches of documents of similar length up to --batch_tokens (with --sparse_input)')
+parser.add_argument('--batch_tokens', type=int, default=0, help='non-zero counts in a batch for --batching tokens, by default batch_size times the average')
 parser.add_argument('--lr', type=float, default=0.005, help='learning rate')
 parser.add_argument('--lr_factor', type=float, default=4.0, help='divide learning rate by this...')
 parser.add_argument('-e', '--epochs', type=int, default=20, help='number of epochs to train...150 for 20ng 100 for others')
@@ -57,6 +61,14 @@ parser.add_argument('--wdecay', type=float, default=1.2e-6, help='some l2 regula
 parser.add_argument('--anneal_lr', type=int, default=0, help='whether to anneal the learning rate or not')
 parser.add_argument('--bow_norm', type=int, default=1, help='normalize the bows or not')
 parser.add_argument('--cpu', default=False, action='store_true', help='whether to force using cpu')
+parser.add_argument('--precision', type=str, default='fp32', help='fp32, bf16 or fp16 for the matmuls of the encoder and decoder (under autocast)')
+parser.add_argument('--prefetch', type=int, default=2, help='number of batches built ahead in the background, 0 to build them in the main thread')
+parser.add_argument('--loader_workers', type=int, default=1, help='number of threads building batches')
+parser.add_argument('--distributed', type=int, default=0, help='number of training processes on this host with gradients averaged over gloo, any positive number under torchrun for several hosts')
+parser.add_argument('--master_port', type=int, default=29500, help='port of the rendezvous of the local --distributed processes')
+parser.add_argument('--resident', default=False, action='store_true', help='keep the training split on the device with precomputed normalised counts')
+parser.add_argument('--num_negatives', type=int, default=0, help='train with the softmax over the words of a batch and this number of words sampled by their frequency, 0 for the full vocabulary')
+parser.add_argument('--sparse_input', default=False, action='store_true', help='use only the non-zero entries of the bows in the encoder and in the loss instead of the bsz x V matrices')
 
 ### evaluation, visualization, and logging-related arguments
 parser.add_argument('-k', '--num_words', type=int, default=20, help='number of words for topic viz')
@@ -65,6 +77,9 @@ parser.add_argument('--log_interval', type=int, default=200, help='when to log t
 parser.add_argument('--visualize_every', type=int, default=10, help='when to visualize results')
 parser.add_argument('--eval_batch_size', type=int, default=1000, help='input batch size for evaluation')
 parser.add_argument('-l', '--load_from', type=str, default='', help='the name of the ckpt to eval from')
+parser.add_argument('--npz', type=str, default='', help='.npz file with the encoder and vocabulary (-d) for etm_numpy.py, written by the export mode')
+parser.add_argument('--quantize', default=False, action='store_true', help='int8 encoder on CPU for apply, eval reports its agreement with the float one')
+parser.add_argument('--script', type=str, default='', help='TorchScript file with the inference graph for --batch_size documents, written by the export mode and used by apply instead of the ckpt')
 parser.add_argument('--queries', type=str, default='', help='space-separated words to visualise embeddings')
 parser.add_argument('--tc', default=False, action='store_true', help='whether to compute topic coherence; this is time consuming')
 parser.add_argument('--td', default=False, action='store_true', help='whether to compute topic diversity')
@@ -75,6 +90,33 @@ parser.add_argument('--topK', type=int, default=3, help='max number of topics fo
 
 
 args = parser.parse_args()
+if args.num_negatives > 0: # the sampled softmax needs the word ids of the batches
+    args.sparse_input = True
+if args.batching == 'tokens': # a batch of short documents can have many more than --batch_size rows
+    args.sparse_input = True
+if args.quantize: # dynamic int8 kernels are for CPU
+    args.cpu = True
+
+if args.distributed > 0 and args.mode == 'train' and 'RANK' not in os.environ:
+    # start the workers on this host (torchrun sets RANK and the rest for several hosts) and wait for them
+    env = dict(os.environ, WORLD_SIZE=str(args.distributed), LOCAL_WORLD_SIZE=str(args.distributed), 
+               MASTER_ADDR='127.0.0.1', MASTER_PORT=str(args.master_port))
+    workers = [subprocess.Popen([sys.executable] + sys.argv, env=dict(env, RANK=str(r), LOCAL_RANK=str(r))) 
+                   for r in range(args.distributed)]
+    sys.exit(max(w.wait() for w in workers))
+
+rank = 0
+world_size = 1
+if args.distributed > 0 and args.mode == 'train':
+    import torch.distributed as dist
+    dist.init_process_group('gloo') # from RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+    if 'OMP_NUM_THREADS' not in os.environ: # share the cores of the host
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // int(os.environ.get('LOCAL_WORLD_SIZE', world_size))))
+    if rank > 0: # only the first worker reports and saves the model
+        args.verbosity = 0
+        args.output = os.devnull
 
 device = torch.device("cuda" if torch.cuda.is_available() and not args.cpu else "cpu")
 
@@ -91,11 +133,12 @@ if args.mode == 'apply':
     vocab=pickle.load(open(args.dictionary,'rb'))
     vocab_size = len(vocab)
     args.vocab_size = vocab_size
-    token_file = os.path.join(args.data_path, 'bow_ts_tokens.mat')
-    count_file = os.path.join(args.data_path, 'bow_ts_counts.mat')
-    train_tokens = scipy.io.loadmat(token_file)['tokens'].squeeze()
-    train_counts = scipy.io.loadmat(count_file)['counts'].squeeze()
+    train_tokens, train_counts = data.load_split(args.data_path, 'ts')
     args.num_docs_train = len(train_tokens)
+elif args.mode in ['export', 'report']:
+    vocab_size = None # from the model
+    if args.npz or args.mode == 'report':
+        vocab = pickle.load(open(args.dictionary or os.path.join(args.data_path, 'vocab.pkl'),'rb'))
 else:
     # 1. vocabulary
     vocab, train, valid, test = data.get_data(os.path.join(args.data_path))
@@ -105,7 +148,12 @@ else:
     # 1. training data
     train_tokens = train['tokens']
     train_counts = train['counts']
+    train_weights = train['weights']
+    if train_weights is not None:
+        train_weights = torch.from_numpy(train_weights.astype(np.float32)).to(device)
     args.num_docs_train = len(train_tokens)
+    if args.batching == 'tokens' and args.batch_tokens <= 0:
+        args.batch_tokens = int(args.batch_size * train_tokens.nnz() / max(args.num_docs_train, 1))
 
     # 2. dev set
     valid_tokens = valid['tokens']
@@ -128,24 +176,11 @@ if args.verbosity>0:
     print('Loaded data in {} secs'.format(xtime-starttime))
 embeddings = None
 if not args.train_embeddings:
-    emb_path = args.emb_path
-    vect_path = os.path.join(args.data_path.split('/')[0], 'embeddings.pkl')   
-    vectors = {}
-    with open(emb_path, 'rb') as f:
-        for l in f:
-            line = l.decode().split()
-            word = line[0]
-            if word in vocab:
-                vect = np.array(line[1:]).astype(np.float)
-                vectors[word] = vect
-    embeddings = np.zeros((vocab_size, args.emb_size))
-    words_found = 0
-    for i, word in enumerate(vocab):
-        try: 
-            embeddings[i] = vectors[word]
-            words_found += 1
-        except KeyError:
-            embeddings[i] = np.random.normal(scale=0.6, size=(args.emb_size, ))
+    vectors, oov = data.load_embeddings(args.emb_path, vocab, args.emb_size, args.data_path)
+    embeddings = np.array(vectors)
+    embeddings[oov] = np.random.normal(scale=0.6, size=(oov.sum(), args.emb_size))
+    if args.verbosity>0:
+        print(f'Found embeddings for {len(oov)-oov.sum()} out of {len(oov)} words', file=sys.stderr)
     embeddings = torch.from_numpy(embeddings).to(device)
     args.embeddings_dim = embeddings.size()
 
@@ -155,15 +190,27 @@ if args.verbosity>0:
 
 ## define checkpoint
 if not os.path.exists(args.save_path):
-    os.makedirs(args.save_path)
-
-if args.mode in ['eval', 'apply']:
+    os.makedirs(args.save_path, exist_ok=True)
+
+if args.mode == 'apply' and args.script:
+    model = None
+    scripted, script_meta = load_script(args.script, device)
+    args.num_topics = script_meta['num_topics']
+    assert script_meta['vocab_size'] == vocab_size, f"{args.script} is for a vocabulary of {script_meta['vocab_size']} words"
+elif args.mode == 'report': # only the precomputed parts of the checkpoint are read
+    model = None
+    bundle = load_bundle(args.load_from)
+    assert bundle is not None, f'{args.load_from} is a pickled model without precomputed topics, use --mode eval'
+    assert bundle['vocab_hash'] == vocab_hash(vocab), f'{args.load_from} was trained with a different vocabulary'
+    args.num_topics = bundle['hyperparams']['num_topics']
+elif args.mode in ['eval', 'apply', 'export']:
     ckpt = args.load_from
-    with open(ckpt, 'rb') as f:
-        model = torch.load(f,map_location=torch.device(device))
+    model, bundle = load_model(ckpt, device)
+    if bundle is not None and vocab_size is not None:
+        assert bundle['vocab_hash'] == vocab_hash(vocab), f'{ckpt} was trained with a different vocabulary'
     args.num_topics=model.alphas.out_features  # otherwise the dimensions are not compatible
-    model = model.to(device)
-    model.eval()
+    if args.mode == 'apply' and args.quantize:
+        model = quantize_encoder(model, args.sparse_input)
 else:
     ckpt = os.path.join(args.save_path, 
         f'etm_{args.dataset}_K_{args.num_topics}_Htheta_{args.t_hidden_size}_Lr_{args.lr}_RhoSize_{args.rho_size}')
@@ -172,7 +219,9 @@ else:
 
 print('model: {}'.format(model))
 
-if args.optimizer == 'adam':
+if model is None: # the scripted graph is only applied
+    optimizer = None
+elif args.optimizer == 'adam':
     optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.wdecay)
 elif args.optimizer == 'adagrad':
     optimizer = optim.Adagrad(model.parameters(), lr=args.lr, weight_decay=args.wdecay)
@@ -186,41 +235,99 @@ else:
     print('Defaulting to vanilla SGD')
     optimizer = optim.SGD(model.parameters(), lr=args.lr)
 
+def autocast():
+    """Runs the matmuls in --precision, the parameters and checkpoints stay in float32."""
+    if args.precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(device.type, dtype=torch.bfloat16 if args.precision == 'bf16' else torch.float16)
+
+# float16 gradients need loss scaling (torch.amp.GradScaler is in Pytorch 2.3 or later), fp32 and bf16 go without it
+scaler = torch.amp.GradScaler(device.type) if args.precision == 'fp16' else None
+
+def batches(tokens, counts, indices, sparse=None):
+    sparse = args.sparse_input if sparse is None else sparse
+    return data.BatchLoader(tokens, counts, indices, args.vocab_size, device, args.bow_norm, args.prefetch, args.loader_workers, sparse)
+
+def sync_gradients():
+    """Sums the gradients of the shares of a batch over the workers, a worker with an empty share adds zeros."""
+    for p in model.parameters():
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+        dist.all_reduce(p.grad)
+
+def backward(loss):
+    if scaler is None:
+        loss.backward()
+    else:
+        scaler.scale(loss).backward()
+
+def optimizer_step():
+    if args.clip > 0:
+        if scaler is not None:
+            scaler.unscale_(optimizer)
+        torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
+    if scaler is None:
+        optimizer.step()
+    else:
+        scaler.step(optimizer)
+        scaler.update()
+
 def train(epoch):
     model.train()
     acc_loss = 0
     acc_kl_theta_loss = 0
     cnt = 0
-    indices = torch.randperm(args.num_docs_train)
-    indices = torch.split(indices, args.batch_size)
-    for idx, ind in enumerate(indices):
+    if args.batching == 'tokens':
+        indices = data.token_batches(train_tokens, args.batch_tokens, perm_generator)
+    else:
+        indices = torch.randperm(args.num_docs_train, generator=perm_generator)
+        indices = torch.split(indices, args.batch_size)
+    shares = None
+    if world_size > 1: # every worker gets the same permutation and takes its share of each batch
+        full = indices
+        indices = [ind[rank::world_size] for ind in full]
+        # the loss of a share is weighted by its part of the batch, so that the summed gradients are those of the whole batch
+        if train_weights is None:
+            shares = [len(ind) / len(f) for ind, f in zip(indices, full)]
+        else:
+            shares = [(train_weights[ind.to(device)].sum() / train_weights[f.to(device)].sum()).item() for ind, f in zip(indices, full)]
+    if args.resident:
+        loader = data.DeviceLoader(train_resident, [ind for ind in indices if len(ind) > 0], args.sparse_input)
+    else:
+        loader = batches(train_tokens, train_counts, [ind for ind in indices if len(ind) > 0])
+    loaded = iter(loader)
+    for idx in range(len(indices)):
         optimizer.zero_grad()
         model.zero_grad()
-        data_batch = data.get_batch(train_tokens, train_counts, ind, args.vocab_size, device)
-        sums = data_batch.sum(1).unsqueeze(1)
-        if args.bow_norm:
-            normalized_data_batch = data_batch / sums
-        else:
-            normalized_data_batch = data_batch
-        recon_loss, kld_theta = model(data_batch, normalized_data_batch)
-        total_loss = recon_loss + kld_theta
-        total_loss.backward()
-
-        if args.clip > 0:
-            torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
-        optimizer.step()
-
-        acc_loss += torch.sum(recon_loss).item()
-        acc_kl_theta_loss += torch.sum(kld_theta).item()
+        if len(indices[idx]) > 0: # a share of a batch smaller than the number of workers can be empty
+            ind, data_batch, normalized_data_batch = next(loaded)
+            weights = None
+            if train_weights is not None:
+                weights = train_weights[ind.to(device)]
+            with autocast():
+                recon_loss, kld_theta = model(data_batch, normalized_data_batch, weights=weights, sampler=sampler)
+            total_loss = recon_loss + kld_theta
+            if shares is not None:
+                recon_loss, kld_theta, total_loss = recon_loss * shares[idx], kld_theta * shares[idx], total_loss * shares[idx]
+            backward(total_loss)
+            acc_loss += torch.sum(recon_loss).item()
+            acc_kl_theta_loss += torch.sum(kld_theta).item()
+        if world_size > 1:
+            sync_gradients()
+        optimizer_step()
         cnt += 1
 
-        if idx % args.log_interval == 0 and idx > 0:
+        if idx % args.log_interval == 0 and idx > 0 and rank == 0:
             cur_loss = round(acc_loss / cnt, 2) 
             cur_kl_theta = round(acc_kl_theta_loss / cnt, 2) 
             cur_real_loss = round(cur_loss + cur_kl_theta, 2)
 
             print('Epoch: {} .. batch: {}/{} .. LR: {} .. KL_theta: {} .. Rec_loss: {} .. NELBO: {}'.format(
                 epoch, idx, len(indices), optimizer.param_groups[0]['lr'], cur_kl_theta, cur_loss, cur_real_loss),file=sys.stderr)
+    if world_size > 1: # the losses of the whole batches
+        totals = torch.tensor([acc_loss, acc_kl_theta_loss], dtype=torch.float64)
+        dist.all_reduce(totals)
+        acc_loss, acc_kl_theta_loss = totals.tolist()
     
     cur_loss = round(acc_loss / cnt, 2) 
     cur_kl_theta = round(acc_kl_theta_loss / cnt, 2) 
@@ -229,11 +336,13 @@ def train(epoch):
     print('Epoch----->{} .. LR: {} .. KL_theta: {} .. Rec_loss: {} .. NELBO: {}'.format(
             epoch, optimizer.param_groups[0]['lr'], cur_kl_theta, cur_loss, cur_real_loss),file=outfile)
     print('*'*100,file=outfile)
+    if args.verbosity>0:
+        print(f'Waited for input batches {round(loader.wait, 2)} secs', file=sys.stderr)
     return cur_kl_theta, cur_real_loss
 
 def visualize(m, show_emb=True):
     if not os.path.exists('./results'):
-        os.makedirs('./results')
+        os.makedirs('./results', exist_ok=True)
 
     m.eval()
 
@@ -242,10 +351,9 @@ def visualize(m, show_emb=True):
         print('#'*100)
         print('Visualize topics...')
         topics_words = []
-        gammas = m.get_beta()
+        top_ids = m.top_words(args.num_words-1).cpu().numpy()
         for k in range(args.num_topics):
-            gamma = gammas[k]
-            top_words = list(gamma.cpu().numpy().argsort()[-args.num_words+1:][::-1])
+            top_words = top_ids[k]
             topic_words = [vocab[a] for a in top_words]
             topics_words.append(' '.join(topic_words))
             print('Topic {}: {}'.format(k, topic_words),file=outfile)
@@ -285,22 +393,20 @@ def evaluate(m, source, tc=False, td=False):
         acc_loss = 0
         cnt = 0
         indices_1 = torch.split(torch.tensor(range(args.num_docs_test_1)), args.eval_batch_size)
-        for idx, ind in enumerate(indices_1):
+        for (ind, data_batch_1, normalized_data_batch_1), (_, data_batch_2, _) in zip(
+                batches(test_1_tokens, test_1_counts, indices_1), batches(test_2_tokens, test_2_counts, indices_1)):
             ## get theta from first half of docs
-            data_batch_1 = data.get_batch(test_1_tokens, test_1_counts, ind, args.vocab_size, device)
-            sums_1 = data_batch_1.sum(1).unsqueeze(1)
-            if args.bow_norm:
-                normalized_data_batch_1 = data_batch_1 / sums_1
-            else:
-                normalized_data_batch_1 = data_batch_1
-            theta, _ = m.get_theta(normalized_data_batch_1)
+            with autocast():
+                theta, _ = m.get_theta(normalized_data_batch_1)
 
             ## get prediction loss using second half
-            data_batch_2 = data.get_batch(test_2_tokens, test_2_counts, ind, args.vocab_size, device)
-            sums_2 = data_batch_2.sum(1).unsqueeze(1)
-            res = torch.mm(theta, beta)
-            preds = torch.log(res)
-            recon_loss = -(preds * data_batch_2).sum(1)
+            sums_2 = data.row_sums(data_batch_2).unsqueeze(1)
+            if args.sparse_input:
+                recon_loss = -m.decode_sparse(theta, beta, data_batch_2, eps=0)
+            else:
+                res = torch.mm(theta, beta)
+                preds = torch.log(res)
+                recon_loss = -(preds * data_batch_2).sum(1)
             
             loss = recon_loss / sums_2.squeeze()
             loss = loss.mean().item()
@@ -324,9 +430,76 @@ def evaluate(m, source, tc=False, td=False):
                 print(f'TD*TC={round(td_val*tc_val,4)}', file=outfile)
         return ppl_dc
 
+def quantized_theta(q, normalized_data_batch):
+    """theta from the int8 encoder q.  The dynamic quantisation of a batch fails on the NaN rows of empty documents,
+    so they go through it as zeros and get NaN theta afterwards, as from the float encoder."""
+    if isinstance(normalized_data_batch, data.SparseBatch):
+        nan_rows = torch.zeros(len(normalized_data_batch.offsets)-1, dtype=torch.bool, device=normalized_data_batch.values.device)
+        nan_rows[normalized_data_batch.rows[normalized_data_batch.values.isnan()]] = True
+        normalized_data_batch = normalized_data_batch._replace(values=normalized_data_batch.values.nan_to_num())
+    else:
+        nan_rows = normalized_data_batch.isnan().any(1)
+        normalized_data_batch = normalized_data_batch.nan_to_num()
+    theta, _ = q.get_theta(normalized_data_batch)
+    theta[nan_rows] = float('nan')
+    return theta
+
+def topk_agreement(m, q, tokens, counts, k):
+    """Compares the topics of the float model m and the quantised one q on the documents of a held-out split,
+    with empty documents mixed in (one per 20), which both should leave without topics with --bow_norm."""
+    n = len(tokens)
+    n_empty = max(1, n // 20)
+    tokens = data.Documents(tokens.shards + [(np.zeros(n_empty+1, dtype=np.int64), np.zeros(0, dtype=np.int32))])
+    counts = data.Documents(counts.shards + [(np.zeros(n_empty+1, dtype=np.int64), np.zeros(0, dtype=np.int32))])
+    order = np.argsort(np.concatenate([np.arange(n), np.linspace(0, n, n_empty, endpoint=False) + 0.5]), kind='stable')
+    indices = torch.split(torch.from_numpy(order), args.eval_batch_size)
+    top1 = overlap = diff = 0.0
+    same_empty = 0
+    secs_m = secs_q = 0.0
+    for ind, data_batch, normalized_data_batch in batches(tokens, counts, indices):
+        started = time.time()
+        theta_m, _ = m.get_theta(normalized_data_batch)
+        secs_m += time.time() - started
+        started = time.time()
+        theta_q = quantized_theta(q, normalized_data_batch)
+        secs_q += time.time() - started
+        top_m = theta_m.topk(k, dim=-1).indices
+        top_q = theta_q.topk(k, dim=-1).indices
+        top_m[theta_m.isnan().any(1)] = -1 # no topics
+        top_q[theta_q.isnan().any(1)] = -1
+        empty = (ind >= n).to(device)
+        same = (top_m == top_q).all(1)
+        same_empty += same[empty].sum().item()
+        top_m, top_q, theta_m, theta_q = top_m[~empty], top_q[~empty], theta_m[~empty], theta_q[~empty]
+        top1 += (top_m[:, 0] == top_q[:, 0]).sum().item()
+        overlap += (top_m.unsqueeze(2) == top_q.unsqueeze(1)).any(2).sum().item() / k
+        diff += (theta_m - theta_q).abs().sum().item() / theta_m.shape[1]
+    print(f'Int8 encoder on {n} held-out documents: top-1 agreement {round(top1/n, 4)}, top-{k} overlap {round(overlap/n, 4)}, ' 
+          f'mean |theta difference| {diff/n:.2e}; the same topics for {same_empty} of {n_empty} added empty documents', file=outfile)
+    n += n_empty
+    print(f'Encoder size {round(encoder_bytes(m)/2**20, 1)} MB float32, {round(encoder_bytes(q)/2**20, 1)} MB int8; ' 
+          f'{int(n/max(secs_m, 1e-9))} docs/sec float32, {int(n/max(secs_q, 1e-9))} docs/sec int8', file=outfile)
+
 if args.mode == 'train':
     print('=*'*100)
     print(f'Training an Embedded Topic Model on {args.dataset.upper()} with the following settings: {args}')
+    hyperparams = {'num_topics': args.num_topics, 'vocab_size': vocab_size, 't_hidden_size': args.t_hidden_size, 
+                   'rho_size': args.rho_size, 'emsize': args.emb_size, 'theta_act': args.theta_act, 
+                   'train_embeddings': bool(args.train_embeddings), 'enc_drop': args.enc_drop}
+    # the batches are drawn from their own generator, the same in all workers
+    perm_generator = None
+    if world_size > 1:
+        perm_generator = torch.Generator().manual_seed(args.seed)
+        for p in model.parameters(): # start from the same model
+            dist.broadcast(p.data, 0)
+        torch.manual_seed(args.seed + rank) # while the sampling noise differs
+    sampler = None
+    if args.num_negatives > 0:
+        freqs = sum(np.bincount(words, weights=values, minlength=args.vocab_size) 
+                        for (_, words), (_, values) in zip(train_tokens.shards, train_counts.shards))
+        sampler = NegativeSampler(freqs ** 0.75, args.num_negatives, device)
+    if args.resident:
+        train_resident = data.DeviceDataset(train_tokens, train_counts, args.vocab_size, device, args.bow_norm)
     ## train model on data 
     best_epoch = 0
     best_val_ppl = 1e9
@@ -341,8 +514,8 @@ if args.mode == 'train':
         kl_theta,nelbo=train(epoch)
         val_ppl = evaluate(model, 'val')
         if (args.best=='val_ppl' and val_ppl < best_val_ppl) or (args.best=='kl_theta' and kl_theta > best_kl_theta) or (args.best=='nelbo' and nelbo < best_nelbo):
-            with open(ckpt, 'wb') as f:
-                torch.save(model, f)
+            if rank == 0:
+                save_bundle(model, ckpt, hyperparams, vocab)
             best_epoch = epoch
             best_val_ppl = val_ppl
             best_kl_theta = kl_theta
@@ -356,20 +529,17 @@ if args.mode == 'train':
             visualize(model)
         all_val_ppls.append(val_ppl)
         outfile.flush()
-    with open(ckpt, 'rb') as f:
-        model = torch.load(f,map_location=torch.device(device))
-    model = model.to(device)
+    if world_size > 1:
+        dist.barrier() # the checkpoint is complete
+    model, _ = load_model(ckpt, device)
     val_ppl = evaluate(model, 'val')
 elif args.mode=='eval':   
-    with open(ckpt, 'rb') as f:
-        model = torch.load(f,map_location=torch.device(device))
-    model = model.to(device)
-    model.eval()
-
     with torch.no_grad():
         ## get document completion perplexities
         test_ppl = evaluate(model, 'test', tc=args.tc, td=args.td)
         beta = model.get_beta()
+        if args.quantize:
+            topk_agreement(model, quantize_encoder(model, args.sparse_input), test_tokens, test_counts, args.topK)
 
         if args.tp: ## get most used topics
             indices = torch.tensor(range(args.num_docs_train))
@@ -377,15 +547,11 @@ elif args.mode=='eval':
             thetaAvg = torch.zeros(1, args.num_topics).to(device)
             thetaWeightedAvg = torch.zeros(1, args.num_topics).to(device)
             cnt = 0
-            for idx, ind in enumerate(indices):
-                data_batch = data.get_batch(train_tokens, train_counts, ind, args.vocab_size, device)
-                sums = data_batch.sum(1).unsqueeze(1)
+            for idx, (ind, data_batch, normalized_data_batch) in enumerate(batches(train_tokens, train_counts, indices)):
+                sums = data.row_sums(data_batch).unsqueeze(1)
                 cnt += sums.sum(0).squeeze().cpu().numpy()
-                if args.bow_norm:
-                    normalized_data_batch = data_batch / sums
-                else:
-                    normalized_data_batch = data_batch
-                theta, _ = model.get_theta(normalized_data_batch)
+                with autocast():
+                    theta, _ = model.get_theta(normalized_data_batch)
                 thetaAvg += theta.sum(0).unsqueeze(0) / args.num_docs_train
                 weighed_theta = sums * theta
                 thetaWeightedAvg += weighed_theta.sum(0).unsqueeze(0)
@@ -394,9 +560,9 @@ elif args.mode=='eval':
             thetaWeightedAvg = thetaWeightedAvg.squeeze().cpu().numpy() / cnt
             toptopics=thetaWeightedAvg.argsort()[::-1][:args.toptopicsnum]
             print(f'\nThe {args.toptopicsnum} most used topics are {toptopics}', file=outfile)
+            top_ids = model.top_words(args.num_words-1).cpu().numpy()
             for k in toptopics:
-                gamma = beta[k]
-                top_word_ids = list(gamma.cpu().numpy().argsort()[-args.num_words+1:][::-1])
+                top_word_ids = top_ids[k]
                 topic_words = [vocab[a] for a in top_word_ids]
                 print(f'Topic {k}: {topic_words}',file=outfile)
 
@@ -404,48 +570,80 @@ elif args.mode=='eval':
 
         ## show full topics
         print('\n',file=outfile)
+        top_ids = model.top_words(args.num_words-1).cpu().numpy()
         for k in range(args.num_topics):
             gamma = beta[k]
-            top_word_ids = list(gamma.cpu().numpy().argsort()[-args.num_words+1:][::-1])
+            top_word_ids = top_ids[k]
             topic_words = [(vocab[a],float(gamma[a])) for a in top_word_ids]
             print(f'Topic {k}: {topic_words}',file=outfile)
 
         if args.train_embeddings:
             ## show etm embeddings 
-            try:
-                rho_etm = model.rho.weight.cpu()
-            except:
-                rho_etm = model.rho.cpu()
+            if bundle is not None:
+                rho_etm = bundle['rho_normalized']
+            else:
+                try:
+                    rho_etm = model.rho.weight.cpu()
+                except:
+                    rho_etm = model.rho.cpu()
             print('\n',file=outfile)
             print('ETM embeddings...',file=outfile)
             for word in queries:
                 print('word: {} .. etm neighbors: {}'.format(word, nearest_neighbors(word, rho_etm, vocab)),file=outfile)
             print('\n',file=outfile)
+elif args.mode=='report':
+    beta = bundle['beta']
+    top_ids = bundle['top_words'][:, :args.num_words-1]
+    for k in range(args.num_topics):
+        top_word_ids = top_ids[k].tolist()
+        topic_words = [(vocab[a],float(p)) for a, p in zip(top_word_ids, beta[k, top_word_ids])]
+        print(f'Topic {k}: {topic_words}',file=outfile)
+    for word in queries:
+        print('word: {} .. etm neighbors: {}'.format(word, nearest_neighbors(word, bundle['rho_normalized'], vocab)),file=outfile)
+elif args.mode=='export':
+    if args.script:
+        meta = export_script(model, args.batch_size, args.topK, args.script)
+        print(f'Saved the inference graph for {meta} to {args.script}', file=sys.stderr)
+    if args.npz:
+        dictionary = args.dictionary or os.path.join(args.data_path, 'vocab.pkl')
+        assert len(vocab) == model.vocab_size, f'{dictionary} does not match the model'
+        if bundle is not None:
+            assert bundle['vocab_hash'] == vocab_hash(vocab), f'{ckpt} was trained with a different vocabulary than {dictionary}'
+        meta = export_npz(model, vocab, args.bow_norm, args.npz)
+        print(f'Saved the encoder for {meta} to {args.npz}', file=sys.stderr)
 elif args.mode=='apply':
     with torch.no_grad():
-        beta = model.get_beta()
         ## get most used topics
+        if args.script: # the graph has fixed shapes
+            args.batch_size = script_meta['batch_size']
         indices = torch.tensor(range(args.num_docs_train))
         indices = torch.split(indices, args.batch_size)
         thetaAvg = torch.zeros(1, args.num_topics).to(device)
         thetaWeightedAvg = torch.zeros(1, args.num_topics).to(device)
         cnt = 0
-        for idx, ind in enumerate(indices):
-            data_batch = data.get_batch(train_tokens, train_counts, ind, args.vocab_size, device)
-            sums = data_batch.sum(1).unsqueeze(1)
+        loader = batches(train_tokens, train_counts, indices, sparse=False if args.script else None)
+        for idx, (ind, data_batch, normalized_data_batch) in enumerate(loader):
+            sums = data.row_sums(data_batch).unsqueeze(1)
             cnt += sums.sum(0).squeeze().cpu().numpy()
-            if args.bow_norm:
-                normalized_data_batch = data_batch / sums
+            if args.script:
+                n = len(ind)
+                if n < args.batch_size: # the last batch is padded with empty documents
+                    normalized_data_batch = F.pad(normalized_data_batch, (0, 0, 0, args.batch_size-n))
+                theta, topvalues, topids = [t[:n] for t in scripted(normalized_data_batch)]
+            elif args.quantize:
+                theta = quantized_theta(model, normalized_data_batch)
+                topvalues, topids = theta.topk(args.topK, dim=-1)
             else:
-                normalized_data_batch = data_batch
-            theta, _ = model.get_theta(normalized_data_batch)
-            thetabest = theta.argsort()
+                with autocast():
+                    theta, _ = model.get_theta(normalized_data_batch)
+                topvalues, topids = theta.topk(args.topK, dim=-1)
+            topvalues, topids = topvalues[:, :args.topK].tolist(), topids[:, :args.topK].tolist()
             for doc in range(theta.shape[0]): # for each document in the batch
-                besttopics = thetabest[doc,-args.topK:].tolist()
-                bestvalues = theta[doc,besttopics].tolist()
+                besttopics = topids[doc]
+                bestvalues = topvalues[doc]
                 lastv=2.0
                 out=[]
-                for t, v in zip(reversed(besttopics),reversed(bestvalues)):
+                for t, v in zip(besttopics,bestvalues):
                     try: # to handle occasional NaNs
                         outtuple=(float(int(v*1000))/1000,t)
                         if args.threshold>0: 
@@ -466,6 +664,8 @@ elif args.mode=='apply':
                 print('batch: {}/{}'.format(idx, len(indices)),file=sys.stderr)
         thetaWeightedAvg = thetaWeightedAvg.squeeze().cpu().numpy() / cnt
         print('\nThe 10 most used topics are {}'.format(thetaWeightedAvg.argsort()[::-1][:10]))
+        if args.verbosity>0:
+            print(f'Waited for input batches {round(loader.wait, 2)} secs', file=sys.stderr)
 xtime=int(time.time())
 if args.verbosity>0:
     print('Finished in {} secs'.format(xtime-starttime), file=sys.stderr)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark of the data preparation path of data_new.py on a synthetic corpus (or on a real one with -c).
+# Words are drawn from a Zipf distribution over the vocabulary, documents have geometric lengths.
+# The stages are the functions of bow_utils which data_new.py calls for its in-memory, streaming and
+# dictionary (-d, with -j workers) paths.  Each stage is timed and reported with the RSS at its start and end
+# and its own peak RSS (on Linux the high-water mark is reset before each stage, elsewhere it is the peak of the process so far), e.g.:
+#   python3 benchmark.py --docs 1000000 --vocab 200000 --doc_len 20 -j 4 -o bench.json
+# so that changes to the preparation pipeline can be compared run to run.
+# The memory of the worker processes of -j is not included.
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from sklearn.feature_extraction.text import CountVectorizer
+
+import bow_utils
+
+parser = argparse.ArgumentParser(description='Benchmark of the BoW preparation stages')
+parser.add_argument('-c', '--corpusfile', type=str, help='an existing one-line corpus instead of the synthetic one')
+parser.add_argument('--docs', type=int, default=100000, help='number of synthetic documents')
+parser.add_argument('--vocab', type=int, default=50000, help='size of the synthetic vocabulary')
+parser.add_argument('--doc_len', type=int, default=20, help='mean document length')
+parser.add_argument('--zipf', type=float, default=1.1, help='exponent of the Zipf distribution')
+parser.add_argument('--stops', type=int, default=100, help='number of the most frequent synthetic words used as stop words')
+parser.add_argument('-m', '--min_df', type=float, default=5, help='as in data_new.py')
+parser.add_argument('-x', '--max_df', type=float, default=0.7, help='as in data_new.py')
+parser.add_argument('--shard_size', type=int, default=1000000, help='as in data_new.py --stream')
+parser.add_argument('-t', '--tokenise', default=False, action='store_true', help='as in data_new.py')
+parser.add_argument('-l', '--lower', default=False, action='store_true', help='as in data_new.py')
+parser.add_argument('-j', '--workers', type=int, default=1, help='as in data_new.py, for reading and for encoding with the dictionary')
+parser.add_argument('--seed', type=int, default=42)
+parser.add_argument('--keep', default=False, action='store_true', help='keep the temporary directory with the corpus and output')
+parser.add_argument('-o', '--output', type=str, default='-', help='JSON file for the results')
+args = parser.parse_args()
+
+
+def proc_status_mb(key):
+    """VmRSS or VmHWM of this process in MB, None without /proc."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def rss_mb():
+    rss = proc_status_mb('VmRSS')
+    return rss if rss is not None else peak_rss_mb()
+
+
+def peak_rss_mb():
+    peak = proc_status_mb('VmHWM')
+    if peak is not None:
+        return peak
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def reset_peak():
+    """Resets the high-water mark of RSS to the current RSS (Linux 4.0+), False when the peak stays cumulative."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def generate_corpus(fname, num_docs, vocab_size, doc_len, a, seed, chunk_size=10000):
+    """Writes num_docs lines of words w0..wN drawn with probabilities proportional to 1/(rank+1)^a."""
+    rng = np.random.RandomState(seed)
+    probs = 1.0 / np.arange(1, vocab_size+1) ** a
+    cdf = np.cumsum(probs / probs.sum())
+    words = np.array([f'w{i}' for i in range(vocab_size)], dtype=object)
+    with open(fname, 'w') as f:
+        for start in range(0, num_docs, chunk_size):
+            n = min(chunk_size, num_docs - start)
+            lengths = rng.geometric(1.0 / doc_len, size=n)
+            ids = np.minimum(np.searchsorted(cdf, rng.random_sample(lengths.sum())), vocab_size-1)
+            offsets = np.concatenate([[0], np.cumsum(lengths)])
+            f.writelines(' '.join(words[ids[offsets[i]:offsets[i+1]]]) + '\n' for i in range(n))
+
+
+stages = []
+def start():
+    """Time and RSS at the start of a stage, whose peak RSS is counted from here."""
+    reset_peak()
+    return time.time(), rss_mb()
+
+
+def stage(name, started, **info):
+    t, rss_start = started
+    stages.append(dict(stage=name, secs=round(time.time()-t, 3), rss_start_mb=round(rss_start, 1), 
+                       peak_rss_mb=round(peak_rss_mb(), 1), rss_end_mb=round(rss_mb(), 1), **info))
+    s = stages[-1]
+    print(f'{name}: {s["secs"]} secs, RSS {s["rss_start_mb"]} -> {s["rss_end_mb"]} MB, peak {s["peak_rss_mb"]} MB', file=sys.stderr)
+
+
+tmpdir = tempfile.mkdtemp(prefix='etm_bench_')
+corpusfile = args.corpusfile
+if not corpusfile:
+    corpusfile = os.path.join(tmpdir, 'corpus.ol')
+    t = start()
+    generate_corpus(corpusfile, args.docs, args.vocab, args.doc_len, args.zipf, args.seed)
+    stage('generate', t, bytes=os.path.getsize(corpusfile))
+stops = set(f'w{i}' for i in range(args.stops)) if not args.corpusfile else set()
+
+# the in-memory path of data_new.py
+t = start()
+docs = list(bow_utils.read_corpus(corpusfile, args.tokenise, args.lower, args.workers))
+stage('read', t, docs=len(docs))
+
+t = start()
+vocab_aux = bow_utils.fit_vocab(docs, args.min_df, args.max_df)
+stage('countvectorizer_fit', t, vocab=len(vocab_aux))
+
+t = start()
+vocab_aux = bow_utils.remove_stops(vocab_aux, stops)
+stage('stopword_filtering', t, vocab=len(vocab_aux))
+
+t = start()
+idx_tr, idx_ts, idx_va = bow_utils.split_permutation(len(docs), np.random.RandomState(args.seed))
+vocab = bow_utils.train_vocab(docs, idx_tr, {w: j for j, w in enumerate(vocab_aux)})
+word2id = {w: j for j, w in enumerate(vocab)}
+stage('vocabulary_restriction', t, vocab=len(vocab))
+
+t = start()
+docs_tr = bow_utils.encode_docs(docs, idx_tr, word2id)
+stage('encode', t, docs=len(docs_tr))
+
+# the dictionary path (-d) on the whole corpus
+t = start()
+if args.workers > 1:
+    bow_dict = bow_utils.parallel_encode(corpusfile, word2id, args.workers, tokenise=args.tokenise, lower=args.lower)
+else:
+    bow_dict = bow_utils.docs_to_csr(bow_utils.encode_docs(docs, range(len(docs)), word2id), len(vocab))
+stage('dictionary_encode', t, docs=bow_dict.shape[0], workers=args.workers)
+del docs, bow_dict
+
+t = start()
+words, lengths = bow_utils.remove_short(*bow_utils.flatten_docs(docs_tr))
+del docs_tr
+bow = bow_utils.create_bow(bow_utils.create_doc_indices(lengths), words, len(lengths), len(vocab))
+del words, lengths
+stage('create_bow', t, docs=bow.shape[0], nnz=int(bow.nnz))
+
+t = start()
+tokens, counts = bow_utils.split_bow(bow, bow.shape[0])
+del tokens, counts
+stage('split_bow', t)
+
+t = start()
+bow_utils.save_bow(tmpdir, 'bow_tr_mat', bow, 'mat')
+stage('savemat', t)
+
+t = start()
+bow_utils.save_bow(tmpdir, 'bow_tr_npy', bow, 'npy')
+stage('save_npy', t)
+del bow
+
+# the streaming path (--stream)
+t = start()
+df, train_words, num_docs = bow_utils.count_frequencies(bow_utils.read_corpus(corpusfile, args.tokenise, args.lower, args.workers), 
+                                                        CountVectorizer().build_analyzer(), args.seed)
+stage('stream_frequencies', t, docs=num_docs, words=len(df))
+
+t = start()
+vocab = bow_utils.select_vocab(df, train_words, num_docs, args.min_df, args.max_df, stops)
+del df, train_words
+stage('stream_vocabulary', t, vocab=len(vocab))
+
+t = start()
+stream_dir = os.path.join(tmpdir, 'stream')
+os.makedirs(stream_dir)
+writer = bow_utils.ShardWriter(stream_dir, len(vocab), args.shard_size)
+bow_utils.encode_splits(bow_utils.read_corpus(corpusfile, args.tokenise, args.lower, args.workers), 
+                        {w: j for j, w in enumerate(vocab)}, writer, args.seed)
+manifest = writer.close()
+stage('stream_encode', t, shards=sum(len(shards) for shards in manifest['splits'].values()))
+
+results = {'args': vars(args), 'python': platform.python_version(), 'numpy': np.__version__,
+           'cpu_count': os.cpu_count(), 'per_stage_peak': reset_peak(), 'stages': stages,
+           'total_secs': round(sum(s['secs'] for s in stages if s['stage'] != 'generate'), 3)}
+if args.keep:
+    results['tmpdir'] = tmpdir
+else:
+    shutil.rmtree(tmpdir)
+if args.output == '-':
+    json.dump(results, sys.stdout, indent=1)
+    print()
+else:
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
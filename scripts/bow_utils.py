@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Helpers for building BoW datasets with bounded memory.
+# The corpus is read twice as a stream: the first pass collects document frequencies,
+# the second one encodes documents and writes each split as a sequence of numbered shards
+# described by manifest.json in the output directory.
+
+import builtins
+import itertools
+import json
+import os
+import pickle
+import random
+import time
+from collections import Counter
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+from scipy import sparse
+from scipy.io import savemat, loadmat
+from sklearn.feature_extraction.text import CountVectorizer
+from smart_open import open
+
+from tokenise import tokenise_lines
+
+MANIFEST = 'manifest.json'
+SPLITS = ('tr', 'va', 'ts', 'ts_h1', 'ts_h2')
+
+
+def df_threshold(value, num_docs):
+    """Convert a CountVectorizer-style min_df/max_df (proportion if below 1.0, count otherwise) into a count."""
+    return value * num_docs if value < 1.0 else value
+
+
+def df_param(value):
+    """CountVectorizer only accepts proportions as floats and counts as ints."""
+    return value if value < 1.0 else int(value)
+
+
+def split_generator(seed, tr=0.85, ts=0.10):
+    """Yields the split of each consecutive document, the same sequence for the same seed."""
+    rng = random.Random(seed)
+    while True:
+        r = rng.random()
+        yield 'tr' if r < tr else 'ts' if r < tr + ts else 'va'
+
+
+def read_lines(corpusfile):
+    """Lines end only at LF (a bare CR stays inside its line) as in the byte ranges of parallel_encode,
+    so that the documents stay aligned with the lines of the corpus for any number of workers."""
+    with open(corpusfile, 'r', encoding='utf-8', errors='replace', newline='\n') as f:
+        for line in f:
+            yield line
+
+
+def read_corpus(corpusfile, tokenise=False, lower=False, workers=1, chunk_size=10000):
+    """Lines of the corpus, optionally tokenised and lower-cased on the fly by a pool of workers keeping their order."""
+    lines = read_lines(corpusfile)
+    if not tokenise and not lower:
+        yield from lines
+        return
+    process = partial(tokenise_lines, tokenise_text=tokenise, lower=lower)
+    if workers <= 1:
+        for chunk in _chunks(lines, chunk_size):
+            yield from process(chunk)
+        return
+    with Pool(workers) as pool:
+        for chunk in pool.imap(process, _chunks(lines, chunk_size)):
+            yield from chunk
+
+
+def count_frequencies(lines, analyzer, seed):
+    """First pass: document frequencies as seen by CountVectorizer and the set of words found in training docs.
+    Without a seed the split is not known, so the words of all docs are collected."""
+    df = Counter()
+    train_words = set()
+    num_docs = 0
+    splits = split_generator(seed) if seed is not None else itertools.repeat('tr')
+    for line, split in zip(lines, splits):
+        df.update(set(analyzer(line)))
+        if split == 'tr':
+            train_words.update(line.split())
+        num_docs += 1
+    return df, train_words, num_docs
+
+
+def select_vocab(df, train_words, num_docs, min_df, max_df, stops):
+    """Mirrors the in-memory path: df limits, ascending frequency order, no stop words, only words seen in training."""
+    lo = df_threshold(min_df, num_docs)
+    hi = df_threshold(max_df, num_docs)
+    vocab = sorted([w for w, c in df.items() if lo <= c <= hi], key=lambda w: (df[w], w))
+    stops = set(stops)
+    return [w for w in vocab if w not in stops and w in train_words]
+
+
+# Stages of the in-memory path, where the corpus is a list of lines
+
+def fit_vocab(docs, min_df, max_df):
+    """Words within the document frequency limits of CountVectorizer in the ascending order of their frequency."""
+    cvectorizer = CountVectorizer(min_df=df_param(min_df), max_df=df_param(max_df), stop_words=None)
+    cvz = cvectorizer.fit_transform(docs).sign()
+    sum_counts = np.asarray(cvz.sum(axis=0)).ravel()
+    id2word = {j: w for w, j in cvectorizer.vocabulary_.items()}
+    return [id2word[j] for j in np.argsort(sum_counts)]
+
+
+def remove_stops(vocab, stops):
+    stops = set(stops)
+    return [w for w in vocab if w not in stops]
+
+
+def split_permutation(num_docs, rng=np.random, tr=0.85, ts=0.10):
+    """Document ids of the train, test and valid splits from a random permutation."""
+    tr_size = int(np.floor(tr*num_docs))
+    ts_size = int(np.floor(ts*num_docs))
+    idx_permute = rng.permutation(num_docs).astype(int)
+    return idx_permute[:tr_size], idx_permute[tr_size:tr_size+ts_size], idx_permute[tr_size+ts_size:]
+
+
+def train_vocab(docs, idx_tr, word2id):
+    """The words of word2id found in the training documents."""
+    return list(set([w for d in idx_tr for w in docs[d].split() if w in word2id]))
+
+
+def encode_docs(docs, idx, word2id):
+    """Lists of word ids of the documents idx, the words outside word2id are dropped."""
+    return [[word2id[w] for w in docs[d].split() if w in word2id] for d in idx]
+
+
+def encode_splits(lines, word2id, writer, seed):
+    """Streaming path: encodes each line into its split from split_generator(seed) and adds it to the ShardWriter.
+    Empty docs and test docs with length=1 are skipped.  Returns the number of lines read."""
+    num_docs = 0
+    for line, split in zip(lines, split_generator(seed)):
+        num_docs += 1
+        doc = [word2id[w] for w in line.split() if w in word2id]
+        if len(doc)==0 or (split=='ts' and len(doc)==1):
+            continue
+        writer.add(split, doc)
+    return num_docs
+
+
+# Array versions of the BoW stages: a set of documents is kept as a flat array of word ids with document lengths
+
+def flatten_docs(docs):
+    """Converts a list of lists of word ids into a flat array of ids and an array of document lengths."""
+    lengths = np.fromiter((len(doc) for doc in docs), dtype=np.int64, count=len(docs))
+    words = np.fromiter(itertools.chain.from_iterable(docs), dtype=np.int32, count=int(lengths.sum()))
+    return words, lengths
+
+
+def remove_short(words, lengths, min_len=1):
+    """Removes documents shorter than min_len, with min_len=1 only empty documents are removed."""
+    keep = lengths >= min_len
+    return words[np.repeat(keep, lengths)], lengths[keep]
+
+
+def split_halves(words, lengths):
+    """Splits each document into the first floor(len/2) words and the rest."""
+    starts = np.cumsum(lengths) - lengths
+    positions = np.arange(len(words)) - np.repeat(starts, lengths)
+    first = positions < np.repeat(lengths // 2, lengths)
+    return (words[first], lengths // 2), (words[~first], lengths - lengths // 2)
+
+
+def create_doc_indices(lengths):
+    return np.repeat(np.arange(len(lengths), dtype=np.int32), lengths)
+
+
+def create_bow(doc_indices, words, n_docs, vocab_size):
+    """CSR matrix of counts, repeated words in a document are summed on conversion."""
+    ones = np.ones(len(words), dtype=np.int32)
+    return sparse.csr_matrix((ones, (doc_indices, words)), shape=(n_docs, vocab_size))
+
+
+def docs_to_csr(docs, vocab_size):
+    """Converts a list of lists of word ids into a CSR matrix of counts."""
+    words, lengths = flatten_docs(docs)
+    return create_bow(create_doc_indices(lengths), words, len(lengths), vocab_size)
+
+
+def _cells(values, indptr):
+    # object arrays are always saved as cell arrays, even when all documents have the same length
+    cells = np.empty(len(indptr)-1, dtype=object)
+    for i, doc in enumerate(np.split(values, indptr[1:-1])):
+        cells[i] = doc
+    return cells
+
+
+def split_bow(bow_in, n_docs):
+    """Per-document arrays of word ids and of their counts taken as views of the CSR arrays."""
+    indptr = bow_in.indptr[:n_docs+1]
+    return _cells(bow_in.indices, indptr), _cells(bow_in.data, indptr)
+
+
+# Near-duplicate documents (retweets, templated messages) are collapsed into one document with a multiplicity weight.
+# MinHash signatures of the sets of word ids are compared in LSH bands, candidates sharing a band are
+# merged when the share of equal signature values (the estimated Jaccard similarity) reaches the threshold
+
+_PRIME = (1 << 31) - 1
+
+def minhash_signatures(bow, num_perm=64, seed=1, chunk_size=10000):
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, _PRIME, size=(num_perm, 1), dtype=np.int64)
+    b = rng.randint(0, _PRIME, size=(num_perm, 1), dtype=np.int64)
+    sig = np.empty((bow.shape[0], num_perm), dtype=np.int64)
+    for start in range(0, bow.shape[0], chunk_size):
+        part = bow[start:start+chunk_size]
+        lengths = np.diff(part.indptr)
+        nonempty = lengths > 0
+        rows = np.arange(start, start+part.shape[0])
+        sig[rows[~nonempty]] = -1 - rows[~nonempty, None] # empty documents are never duplicates
+        if part.nnz:
+            hashed = (a * part.indices.astype(np.int64) + b) % _PRIME
+            sig[rows[nonempty]] = np.minimum.reduceat(hashed, part.indptr[:-1][nonempty], axis=1).T
+    return sig
+
+
+def lsh_bands(threshold, num_perm):
+    """The number of bands whose similarity threshold (1/b)^(1/r) is the closest to the requested one."""
+    options = [b for b in range(1, num_perm+1) if num_perm % b == 0]
+    return min(options, key=lambda b: abs((1.0/b) ** (b/num_perm) - threshold))
+
+
+def duplicate_clusters(sig, threshold):
+    """For each document returns the smallest index of its cluster of near-duplicates."""
+    n, num_perm = sig.shape
+    bands = lsh_bands(threshold, num_perm)
+    rows = num_perm // bands
+    mult = np.random.RandomState(0).randint(1, _PRIME, size=rows, dtype=np.int64)
+    parent = list(range(n))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for band in range(bands):
+        keys = (sig[:, band*rows:(band+1)*rows] * mult).sum(1) # wraps around, collisions are rejected below
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        rep = first[inverse.ravel()]
+        cand = np.nonzero(rep != np.arange(n))[0]
+        if len(cand) == 0:
+            continue
+        similar = (sig[cand] == sig[rep[cand]]).mean(1) >= threshold
+        for d, r in zip(cand[similar].tolist(), rep[cand][similar].tolist()):
+            rd, rr = find(d), find(r)
+            if rd != rr:
+                parent[max(rd, rr)] = min(rd, rr)
+    return np.array([find(x) for x in range(n)], dtype=np.int64)
+
+
+def collapse_duplicates(bow, threshold, num_perm=64):
+    """Keeps the first document of each cluster of near-duplicates, returns it with the cluster sizes as weights."""
+    if bow.shape[0] == 0:
+        return bow, np.zeros(0, dtype=np.int64)
+    reps, weights = np.unique(duplicate_clusters(minhash_signatures(bow, num_perm), threshold), return_counts=True)
+    return bow[reps], weights
+
+
+def compact_dtype(max_value):
+    """The smallest unsigned integer type which can hold max_value."""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_value <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def save_bow(path, prefix, bow, fmt='npy', weights=None):
+    """Saves a CSR matrix as uncompressed indptr/indices/counts .npy files which can be memory-mapped,
+    or as the legacy compressed .mat cell arrays. Multiplicities of collapsed duplicates are always saved as .npy.
+    Returns the manifest entry of the shard."""
+    if fmt == 'mat':
+        tokens, counts = split_bow(bow, bow.shape[0])
+        savemat(os.path.join(path, prefix + '_tokens.mat'), {'tokens': tokens}, do_compression=True)
+        savemat(os.path.join(path, prefix + '_counts.mat'), {'counts': counts}, do_compression=True)
+    else:
+        max_count = bow.data.max() if bow.nnz else 0
+        np.save(os.path.join(path, prefix + '_indptr.npy'), bow.indptr.astype(np.int64))
+        np.save(os.path.join(path, prefix + '_indices.npy'), bow.indices.astype(compact_dtype(bow.shape[1]-1)))
+        np.save(os.path.join(path, prefix + '_counts.npy'), bow.data.astype(compact_dtype(max_count)))
+    shard = {'file': prefix, 'docs': bow.shape[0], 'format': fmt}
+    if weights is not None:
+        np.save(os.path.join(path, prefix + '_weights.npy'), weights.astype(compact_dtype(weights.max() if len(weights) else 0)))
+        shard['weights'] = int(weights.sum())
+    return shard
+
+
+def load_bow(path, shard, vocab_size):
+    """Reads a shard saved by save_bow as a CSR matrix."""
+    prefix = os.path.join(path, shard['file'])
+    if shard.get('format', 'mat') == 'mat':
+        tokens = loadmat(prefix + '_tokens.mat')['tokens'].ravel()
+        counts = loadmat(prefix + '_counts.mat')['counts'].ravel()
+        lengths = [doc.size for doc in tokens]
+        indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        indices = np.concatenate([doc.ravel() for doc in tokens]) if len(tokens) else np.zeros(0, dtype=np.int32)
+        data = np.concatenate([doc.ravel() for doc in counts]) if len(counts) else np.zeros(0, dtype=np.int32)
+    else:
+        indptr = np.load(prefix + '_indptr.npy')
+        indices = np.load(prefix + '_indices.npy')
+        data = np.load(prefix + '_counts.npy')
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(indptr)-1, vocab_size))
+
+
+class ShardWriter:
+    """Accumulates encoded documents per split and flushes every shard_size documents.
+    Given the manifest of an existing dataset, the numbering of its shards continues."""
+
+    def __init__(self, path, vocab_size, shard_size, fmt='npy', manifest=None, dedup=0):
+        self.path = path
+        self.vocab_size = vocab_size
+        self.shard_size = shard_size
+        self.fmt = fmt
+        self.dedup = dedup
+        self.manifest = manifest if manifest else {'vocab_size': vocab_size, 'splits': {}}
+        self.shards = self.manifest['splits']
+        for split in SPLITS:
+            self.shards.setdefault(split, [])
+        self.buffers = {'tr': [], 'va': [], 'ts': []}
+        self.added = {'tr': 0, 'va': 0, 'ts': 0}
+
+    def add(self, split, doc):
+        self.buffers[split].append(doc)
+        self.added[split] += 1
+        if len(self.buffers[split]) >= self.shard_size:
+            self.flush(split)
+
+    def _write(self, split, words, lengths):
+        prefix = f'bow_{split}_{len(self.shards[split]):03d}'
+        bow = create_bow(create_doc_indices(lengths), words, len(lengths), self.vocab_size)
+        weights = None
+        if split == 'tr' and self.dedup > 0: # near-duplicates are collapsed within each training shard
+            bow, weights = collapse_duplicates(bow, self.dedup)
+        self.shards[split].append(save_bow(self.path, prefix, bow, self.fmt, weights))
+
+    def flush(self, split):
+        if not self.buffers[split]:
+            return
+        words, lengths = flatten_docs(self.buffers[split])
+        self._write(split, words, lengths)
+        if split == 'ts':
+            h1, h2 = split_halves(words, lengths)
+            self._write('ts_h1', *h1)
+            self._write('ts_h2', *h2)
+        self.buffers[split] = []
+
+    def close(self, **info):
+        """Flushes the remaining documents and records the source of this batch of shards in the manifest."""
+        for split in self.buffers:
+            self.flush(split)
+        add_source(self.manifest, docs=dict(self.added), **info)
+        write_manifest(self.path, self.manifest)
+        return self.manifest
+
+
+# Parallel encoding with an existing dictionary.
+# The dictionary is passed once to each worker by the pool initializer,
+# the file is split into byte ranges at line boundaries, so that the results can be joined in the original order
+
+_word2id = None
+_vocab_size = 0
+_tokenise = (False, False)
+
+def _init_encoder(word2id, vocab_size, tokenise=False, lower=False):
+    global _word2id, _vocab_size, _tokenise
+    _word2id = word2id
+    _vocab_size = vocab_size
+    _tokenise = (tokenise, lower)
+
+
+def byte_ranges(fname, n):
+    """Splits a file into n ranges of roughly equal size, each starting at the beginning of a line."""
+    size = os.path.getsize(fname)
+    bounds = [0]
+    with builtins.open(fname, 'rb') as f:
+        for i in range(1, n):
+            f.seek(max(size*i//n - 1, bounds[-1]))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def encode_lines(lines):
+    lines = tokenise_lines(lines, *_tokenise)
+    docs = [[_word2id[w] for w in line.split() if w in _word2id] for line in lines]
+    return docs_to_csr(docs, _vocab_size)
+
+
+def read_range(fname, start, end):
+    with builtins.open(fname, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            yield f.readline().decode('utf-8', errors='replace')
+
+
+def _encode_range(fname, start, end):
+    return encode_lines(list(read_range(fname, start, end)))
+
+
+def _chunks(lines, size):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parallel_encode(corpusfile, word2id, workers, chunk_size=100000, tokenise=False, lower=False):
+    """Encodes each line of corpusfile as a row of a CSR matrix, keeping empty lines to preserve the alignment.
+    Plain files are split into byte ranges, compressed ones are read sequentially and sent to workers in chunks."""
+    with Pool(workers, initializer=_init_encoder, initargs=(word2id, len(word2id), tokenise, lower)) as pool:
+        if os.path.splitext(corpusfile)[1] in ('.gz', '.bz2', '.xz', '.zst'):
+            # imap sends the chunks as they are read (map would read the whole corpus first), only the CSR parts are kept
+            parts = list(pool.imap(encode_lines, _chunks(read_lines(corpusfile), chunk_size)))
+        else:
+            parts = pool.starmap(_encode_range, [(corpusfile, start, end) for start, end in byte_ranges(corpusfile, 4*workers)])
+    if not parts:
+        return sparse.csr_matrix((0, len(word2id)), dtype=int)
+    return sparse.vstack(parts).tocsr()
+
+
+# Map-reduce vocabulary: each worker counts document frequencies in its slice of the corpus (a byte range
+# of a shared file or a file of its own) and saves them, the reduce step merges the counts and selects the vocabulary
+
+def count_part(corpusfile, part, parts, analyzer, tokenise=False, lower=False):
+    """Map step: document frequencies in the part-th of parts byte ranges of corpusfile, the whole file for parts=1."""
+    if parts > 1:
+        ranges = byte_ranges(corpusfile, parts)
+        lines = read_range(corpusfile, *ranges[part]) if part < len(ranges) else iter([])
+    else:
+        lines = read_lines(corpusfile)
+    if tokenise or lower:
+        lines = itertools.chain.from_iterable(tokenise_lines(chunk, tokenise, lower) for chunk in _chunks(lines, 10000))
+    df, words, num_docs = count_frequencies(lines, analyzer, None)
+    return {'df': dict(df), 'words': words, 'num_docs': num_docs, 'corpus': corpusfile, 'part': part, 'parts': parts}
+
+
+def merge_frequencies(fnames):
+    """Reduce step: sums the document frequencies of the parts."""
+    df = Counter()
+    words = set()
+    num_docs = 0
+    for fname in fnames:
+        with open(fname, 'rb') as f:
+            counts = pickle.load(f)
+        df.update(counts['df'])
+        words.update(counts['words'])
+        num_docs += counts['num_docs']
+    return df, words, num_docs
+
+
+def load_vocab(fname):
+    with open(fname, 'rb') as f:
+        return pickle.load(f)
+
+
+def add_source(manifest, **info):
+    """Provenance: each build or append of a dataset is listed with its corpus file, time and parameters."""
+    info['time'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    manifest.setdefault('sources', []).append(info)
+
+
+def dataset_manifest(path):
+    """The manifest of a dataset, for a legacy one without manifest.json it lists the .mat files present on disk."""
+    manifest = read_manifest(path)
+    if manifest is None:
+        splits = {split: [{'file': f'bow_{split}', 'format': 'mat'}] for split in SPLITS
+                      if os.path.isfile(os.path.join(path, f'bow_{split}_tokens.mat'))}
+        manifest = {'splits': splits}
+    if 'vocab_size' not in manifest:
+        manifest['vocab_size'] = len(load_vocab(os.path.join(path, 'vocab.pkl')))
+    return manifest
+
+
+def write_manifest(path, manifest):
+    with open(os.path.join(path, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def read_manifest(path):
+    fname = os.path.join(path, MANIFEST)
+    if not os.path.isfile(fname):
+        return None
+    with open(fname, 'r') as f:
+        return json.load(f)
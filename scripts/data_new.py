@@ -3,8 +3,10 @@
 
 # Serge Sharoff, University of Leeds. An extension from https://github.com/adjidieng/ETM
 # Modifications concern the possibility to choose the parameters and to encode new datasets using the same vocabulary
-# It does read the entire corpus into memory for efficient conversion to the BoW representation.
+# By default it reads the entire corpus into memory for efficient conversion to the BoW representation.
 # For a large (20GW) corpus this ends up with consuming 70G
+# With --stream the corpus is read twice without keeping it in memory and the splits are saved as shards,
+# so the memory footprint depends on the vocabulary size and on --shard_size
 
 import time
 starttime=int(time.time())
@@ -12,13 +14,14 @@ starttime=int(time.time())
 import argparse
 import pickle
 import sys, os, os.path
+import glob
 import random
 from smart_open import open
 
 from sklearn.feature_extraction.text import CountVectorizer
 import numpy as np
-from scipy import sparse
-from scipy.io import savemat, loadmat
+
+import bow_utils
 
 # helper functions
 def make_dictionary(vocab):
@@ -26,114 +29,184 @@ def make_dictionary(vocab):
     id2word = dict([(j, w) for j, w in enumerate(vocab)])
     return word2id, id2word
 
-def create_list_words(in_docs):
-    if args.verbosity>0:
-        print('creating lists of words...', file=sys.stderr)
-    return [x for y in in_docs for x in y]
-
-def create_doc_indices(in_docs):
-    aux = [[j for i in range(len(doc))] for j, doc in enumerate(in_docs)]
-    return [int(x) for y in aux for x in y]
-
-
-def create_bow(doc_indices, words, n_docs, vocab_size):
-    return sparse.coo_matrix(([1]*len(doc_indices),(doc_indices, words)), shape=(n_docs, vocab_size)).tocsr()
-def split_bow(bow_in, n_docs):
-    indices = [[w for w in bow_in[doc,:].indices] for doc in range(n_docs)]
-    counts = [[c for c in bow_in[doc,:].data] for doc in range(n_docs)]
-    return indices, counts
 
 parser = argparse.ArgumentParser(description='The Embedded Topic Model')
 
 ### data and file related arguments
 parser.add_argument('-c', '--corpusfile', type=str, help='corpus file name')
 parser.add_argument('-d', '--dictionary', type=str, help='Use an existing dictionary')
+parser.add_argument('-a', '--append', type=str, help='add the corpus as new train/valid/test shards to an existing dataset directory')
 parser.add_argument('-o', '--output', type=str, help='directory to save BoW corpus')
 parser.add_argument('-s', '--stops', type=str, default='stop-en.txt', help='stop words file')
 parser.add_argument('-m', '--min_df', type=float, default=200, help='Ignore terms that have a document frequency or percentage lower than')
 parser.add_argument('-x', '--max_df', type=float, default=0.7, help='Ignore terms that have a document frequency or percentage higher than')
+parser.add_argument('--df_part', type=str, help='I/N: save document frequencies of the I-th of N byte ranges of the corpus to the output directory')
+parser.add_argument('--reduce', type=str, help='merge the document frequencies saved in this directory into vocab.pkl in the output directory')
+parser.add_argument('--stream', default=False, action='store_true', help='two passes over the corpus without reading it into memory, the output is sharded')
+parser.add_argument('--shard_size', type=int, default=1000000, help='number of documents per shard in the streaming mode')
+parser.add_argument('-f', '--format', type=str, default='npy', choices=['npy', 'mat'], help='memory-mapped .npy arrays or compressed .mat cell arrays')
+parser.add_argument('-t', '--tokenise', default=False, action='store_true', help='tokenise the corpus while reading it with the rules of tokenise1.sh')
+parser.add_argument('-l', '--lower', default=False, action='store_true', help='lower-case the corpus while reading it')
+parser.add_argument('-j', '--workers', type=int, default=1, help='number of processes for tokenising and for encoding with an existing dictionary')
+parser.add_argument('--dedup', type=float, default=0, help='collapse training docs with at least this estimated Jaccard similarity into one weighted doc, e.g., 0.8')
+parser.add_argument('--seed', type=int, default=42, help='random seed for the train/test/valid split in the streaming mode')
 
 parser.add_argument('-v', '--verbosity', type=int, default=1)
 
 args = parser.parse_args()
 
-assert os.path.isfile(args.corpusfile), f'Corpus file {args.corpusfile} does not exist'
-if args.dictionary:
+if args.reduce:
+    assert os.path.isdir(args.reduce), f'Directory {args.reduce} does not exist'
+    assert args.output, 'The output directory for vocab.pkl is needed'
+else:
+    assert os.path.isfile(args.corpusfile), f'Corpus file {args.corpusfile} does not exist'
+if args.df_part:
+    assert args.output, 'The output directory for document frequencies is needed'
+elif args.append:
+    assert os.path.isfile(os.path.join(args.append, 'vocab.pkl')), f'Dataset {args.append} has no vocab.pkl'
+elif args.dictionary:
     assert os.path.isfile(args.dictionary), f'Dictionary file {args.dictionary} does not exist'
 else:
     assert os.path.isfile(args.stops), f'Stop file {args.stops} does not exist'
 
-path_save = args.output + '/' if args.output else args.corpusfile + str(args.min_df) + '/'
+if args.append:
+    path_save = args.append + '/'
+else:
+    path_save = args.output + '/' if args.output else args.corpusfile + str(args.min_df) + '/'
 
 # Read data
-with open(args.corpusfile, 'r') as f:
-    docs = f.readlines()
-if args.verbosity>0:
-    xtime=int(time.time())
-    print(f'Read text file from {args.corpusfile} with {len(docs)} docs')
-    print(f'Loaded data in {xtime-starttime} secs')
+if args.append or args.df_part or args.reduce:
+    in_memory = False
+else:
+    in_memory = args.workers<=1 if args.dictionary else not args.stream
+if in_memory:
+    docs = list(bow_utils.read_corpus(args.corpusfile, args.tokenise, args.lower, args.workers))
+    if args.verbosity>0:
+        xtime=int(time.time())
+        print(f'Read text file from {args.corpusfile} with {len(docs)} docs')
+        print(f'Loaded data in {xtime-starttime} secs')
 
 if not os.path.isdir(path_save):
     os.system('mkdir -p ' + path_save)
 
-if args.dictionary:
+if args.df_part:
+    part, parts = [int(x) for x in args.df_part.split('/')]
+    assert parts==1 or os.path.splitext(args.corpusfile)[1] not in ('.gz', '.bz2', '.xz', '.zst'), 'Byte ranges need an uncompressed corpus'
+    counts = bow_utils.count_part(args.corpusfile, part, parts, CountVectorizer().build_analyzer(), args.tokenise, args.lower)
+    fname = f'{path_save}df_{os.path.basename(args.corpusfile)}_{part:04d}.pkl'
+    with open(fname, 'wb') as f:
+        pickle.dump(counts, f)
+    if args.verbosity>0:
+        print(f'Saved document frequencies of {len(counts["df"])} words in {counts["num_docs"]} docs to {fname}')
+
+elif args.reduce:
+    with open(args.stops, 'r') as f:
+        stops = f.read().split('\n')
+    fnames = sorted(glob.glob(os.path.join(args.reduce, 'df_*.pkl')))
+    df, words, num_docs = bow_utils.merge_frequencies(fnames)
+    vocab = bow_utils.select_vocab(df, words, num_docs, args.min_df, args.max_df, stops)
+    with open(path_save + 'vocab.pkl', 'wb') as f:
+        pickle.dump(vocab, f)
+    manifest = {'vocab_size': len(vocab), 'splits': {}}
+    bow_utils.add_source(manifest, df_parts=fnames, num_docs=num_docs)
+    bow_utils.write_manifest(path_save, manifest)
+    if args.verbosity>0:
+        print(f'Merged {len(fnames)} parts with {num_docs} docs: {len(df)} words, vocabulary of {len(vocab)} words')
+
+elif args.append:
+    # Only the new documents are encoded with the existing vocabulary and added as new shards
+    manifest = bow_utils.dataset_manifest(path_save)
+    vocab = bow_utils.load_vocab(path_save + 'vocab.pkl')
+    word2id, id2word = make_dictionary(vocab)
+    if args.verbosity>0:
+        print(f'Appending to {path_save} with {len(vocab)} words in the dictionary')
+    seed = args.seed + len(manifest.get('sources', [])) # each batch of documents gets its own split sequence
+    writer = bow_utils.ShardWriter(path_save, len(vocab), args.shard_size, args.format, manifest, args.dedup)
+    num_docs = bow_utils.encode_splits(bow_utils.read_corpus(args.corpusfile, args.tokenise, args.lower, args.workers), word2id, writer, seed)
+    manifest = writer.close(corpus=args.corpusfile, seed=seed, num_docs=num_docs, append=True)
+    if args.verbosity>0:
+        print(f'Read {num_docs} docs from {args.corpusfile}, added {manifest["sources"][-1]["docs"]}')
+
+elif args.dictionary:
     vocab=pickle.load(open(args.dictionary,'rb'))
     if args.verbosity>0:
         print(f'Read existing dictionary {len(vocab)} words')
     word2id, id2word = make_dictionary(vocab)
-    tsSize = len(docs)
-    # docs_ts consists of ids of words in vocab
-    docs_ts = [[word2id[w] for w in docs[idx_d].split() if w in word2id] for idx_d in range(tsSize)]
-    if args.verbosity>1: # for testing how doc indices align with the line count in .ol
-        k = 30
-        rr = [0] + sorted(random.sample(range(len(docs)), k))
-        print(rr)
-        for i in rr:
-            doc = docs[i]
-            doc_ts = ' '.join([id2word[id] for id in docs_ts[i]])
-            print(str(i+1)+'\t'+doc[:100]+'\t'+doc_ts[:100])
+    if args.workers>1:
+        xtime=int(time.time())
+        bow_ts = bow_utils.parallel_encode(args.corpusfile, word2id, args.workers, tokenise=args.tokenise, lower=args.lower)
+        n_docs_ts = bow_ts.shape[0]
+        if args.verbosity>0:
+            print(f'Encoded {n_docs_ts} docs from {args.corpusfile} with {args.workers} workers')
+    else:
+        tsSize = len(docs)
+        # docs_ts consists of ids of words in vocab
+        docs_ts = bow_utils.encode_docs(docs, range(tsSize), word2id)
+        if args.verbosity>1: # for testing how doc indices align with the line count in .ol
+            k = 30
+            rr = [0] + sorted(random.sample(range(len(docs)), k))
+            print(rr)
+            for i in rr:
+                doc = docs[i]
+                doc_ts = ' '.join([id2word[id] for id in docs_ts[i]])
+                print(str(i+1)+'\t'+doc[:100]+'\t'+doc_ts[:100])
+
+        del docs
+        bow_ts = bow_utils.docs_to_csr(docs_ts, len(vocab))
+        n_docs_ts = bow_ts.shape[0]
+    if args.verbosity>0:
+        ztime=int(time.time())
+        print('Bow created in {} secs'.format(ztime-xtime))
+    shard = bow_utils.save_bow(path_save, 'bow_ts', bow_ts, args.format)
+    manifest = {'vocab_size': len(vocab), 'splits': {'ts': [shard]}}
+    bow_utils.add_source(manifest, corpus=args.corpusfile, dictionary=args.dictionary, docs={'ts': n_docs_ts})
+    bow_utils.write_manifest(path_save, manifest)
 
-    del docs
-    words_ts = create_list_words(docs_ts)
-    doc_indices_ts = create_doc_indices(docs_ts)
-    n_docs_ts = len(docs_ts)
-    bow_ts = create_bow(doc_indices_ts, words_ts, n_docs_ts, len(vocab))
-    bow_ts_tokens, bow_ts_counts = split_bow(bow_ts, n_docs_ts)
+elif args.stream:
+    with open(args.stops, 'r') as f:
+        stops = f.read().split('\n')
+    # Pass 1: document frequencies with the same tokenisation as CountVectorizer
+    analyzer = CountVectorizer().build_analyzer()
+    df, train_words, num_docs = bow_utils.count_frequencies(bow_utils.read_corpus(args.corpusfile, args.tokenise, args.lower, args.workers), analyzer, args.seed)
+    if args.verbosity>0:
+        xtime=int(time.time())
+        print(f'Read text file from {args.corpusfile} with {num_docs} docs')
+        print(f'  initial vocabulary size: {len(df)}')
+        print(f'Document frequencies collected in {xtime-starttime} secs')
+    vocab = bow_utils.select_vocab(df, train_words, num_docs, args.min_df, args.max_df, stops)
+    del df, train_words
+    word2id, id2word = make_dictionary(vocab)
+    if args.verbosity>0:
+        print(f'  vocabulary after removing stopwords and words not in train: {len(vocab)}', file=sys.stderr)
+    with open(path_save + 'vocab.pkl', 'wb') as f:
+        pickle.dump(vocab, f)
+
+    # Pass 2: encoding, the same seed gives the same split for each document
+    writer = bow_utils.ShardWriter(path_save, len(vocab), args.shard_size, args.format, dedup=args.dedup)
+    # empty docs and test docs with length=1 are removed
+    bow_utils.encode_splits(bow_utils.read_corpus(args.corpusfile, args.tokenise, args.lower, args.workers), word2id, writer, args.seed)
+    manifest = writer.close(corpus=args.corpusfile, seed=args.seed, num_docs=num_docs)
     if args.verbosity>0:
         ztime=int(time.time())
+        for split in ['tr', 'va', 'ts']:
+            shards = manifest['splits'][split]
+            print(f'  number of documents ({split}): {sum(s["docs"] for s in shards)} in {len(shards)} shards')
         print('Bow created in {} secs'.format(ztime-xtime))
-    savemat(path_save + 'bow_ts_tokens.mat', {'tokens': bow_ts_tokens}, do_compression=True)
-    savemat(path_save + 'bow_ts_counts.mat', {'counts': bow_ts_counts}, do_compression=True)
 
 else:
     # Read stopwords
     with open(args.stops, 'r') as f:
         stops = f.read().split('\n')
-    # Create count vectorizer
-    cvectorizer = CountVectorizer(min_df=args.min_df, max_df=args.max_df, stop_words=None)
-    cvz = cvectorizer.fit_transform(docs).sign()
-
-    sum_counts = cvz.sum(axis=0)
-    v_size = sum_counts.shape[1]
-    sum_counts_np = np.zeros(v_size, dtype=int)
-    for v in range(v_size):
-        sum_counts_np[v] = sum_counts[0,v]
-    word2id = dict([(w, cvectorizer.vocabulary_.get(w)) for w in cvectorizer.vocabulary_])
-    id2word = dict([(cvectorizer.vocabulary_.get(w), w) for w in cvectorizer.vocabulary_])
-    del cvectorizer
+    # Create count vectorizer, the vocabulary is sorted by document frequency
+    vocab_aux = bow_utils.fit_vocab(docs, args.min_df, args.max_df)
     if args.verbosity>0:
-        print(f'  initial vocabulary size: {v_size}')
+        print(f'  initial vocabulary size: {len(vocab_aux)}')
         ytime=int(time.time())
         print(f'Initial vocabulary built in {(ytime-xtime)} secs')
-
-    # Sort elements in vocabulary
-    idx_sort = np.argsort(sum_counts_np)
-    vocab_aux = [id2word[idx_sort[cc]] for cc in range(v_size)]
-    if args.verbosity>0:
         print('  vocabulary size before removing stopwords from list: {}'.format(len(vocab_aux)), file=sys.stderr)
 
     # Filter out stopwords (if any)
-    vocab_aux = [w for w in vocab_aux if w not in stops]
+    vocab_aux = bow_utils.remove_stops(vocab_aux, stops)
     if args.verbosity>0:
         print('  vocabulary after removing stopwords: {}'.format(len(vocab_aux)), file=sys.stderr)
 
@@ -143,52 +216,44 @@ else:
     # Split in train/test/valid
     if args.verbosity>0:
         print('tokenizing documents and splitting into train/test/valid...', file=sys.stderr)
-    num_docs = cvz.shape[0]
-    trSize = int(np.floor(0.85*num_docs))
-    tsSize = int(np.floor(0.10*num_docs))
-    vaSize = int(num_docs - trSize - tsSize)
-    del cvz
-    idx_permute = np.random.permutation(num_docs).astype(int)
+    num_docs = len(docs)
+    idx_tr, idx_ts, idx_va = bow_utils.split_permutation(num_docs)
+    trSize, tsSize, vaSize = len(idx_tr), len(idx_ts), len(idx_va)
 
     # Remove words not in train_data
-    vocab = list(set([w for idx_d in range(trSize) for w in docs[idx_permute[idx_d]].split() if w in word2id]))
+    vocab = bow_utils.train_vocab(docs, idx_tr, word2id)
     word2id, id2word = make_dictionary(vocab)
     if args.verbosity>0:
         print('  vocabulary after removing words not in train: {}'.format(len(vocab)), file=sys.stderr)
 
-    docs_tr = [[word2id[w] for w in docs[idx_permute[idx_d]].split() if w in word2id] for idx_d in range(trSize)]
-    docs_ts = [[word2id[w] for w in docs[idx_permute[idx_d+trSize]].split() if w in word2id] for idx_d in range(tsSize)]
-    docs_va = [[word2id[w] for w in docs[idx_permute[idx_d+trSize+tsSize]].split() if w in word2id] for idx_d in range(vaSize)]
+    docs_tr = bow_utils.encode_docs(docs, idx_tr, word2id)
+    docs_ts = bow_utils.encode_docs(docs, idx_ts, word2id)
+    docs_va = bow_utils.encode_docs(docs, idx_va, word2id)
     del docs
 
     print('  number of documents (train): {} [this should be equal to {}]'.format(len(docs_tr), trSize))
     print('  number of documents (test): {} [this should be equal to {}]'.format(len(docs_ts), tsSize))
     print('  number of documents (valid): {} [this should be equal to {}]'.format(len(docs_va), vaSize))
 
-    # Remove empty documents
-    print('removing empty documents...')
-
-    def remove_empty(in_docs):
-        return [doc for doc in in_docs if doc!=[]]
+    # Getting flat arrays of words with document lengths
+    words_tr, lengths_tr = bow_utils.flatten_docs(docs_tr)
+    words_ts, lengths_ts = bow_utils.flatten_docs(docs_ts)
+    words_va, lengths_va = bow_utils.flatten_docs(docs_va)
+    del docs_tr
+    del docs_ts
+    del docs_va
 
-    docs_tr = remove_empty(docs_tr)
-    docs_ts = remove_empty(docs_ts)
-    docs_va = remove_empty(docs_va)
+    # Remove empty documents
+    print('removing empty documents...')
+    words_tr, lengths_tr = bow_utils.remove_short(words_tr, lengths_tr)
+    words_va, lengths_va = bow_utils.remove_short(words_va, lengths_va)
 
     # Remove test documents with length=1
-    docs_ts = [doc for doc in docs_ts if len(doc)>1]
+    words_ts, lengths_ts = bow_utils.remove_short(words_ts, lengths_ts, 2)
 
     # Split test set in 2 halves
     print('splitting test documents in 2 halves...')
-    docs_ts_h1 = [[w for i,w in enumerate(doc) if i<=len(doc)/2.0-1] for doc in docs_ts]
-    docs_ts_h2 = [[w for i,w in enumerate(doc) if i>len(doc)/2.0-1] for doc in docs_ts]
-
-    # Getting lists of words and doc_indices
-    words_tr = create_list_words(docs_tr)
-    words_ts = create_list_words(docs_ts)
-    words_ts_h1 = create_list_words(docs_ts_h1)
-    words_ts_h2 = create_list_words(docs_ts_h2)
-    words_va = create_list_words(docs_va)
+    (words_ts_h1, lengths_ts_h1), (words_ts_h2, lengths_ts_h2) = bow_utils.split_halves(words_ts, lengths_ts)
 
     if args.verbosity>0:
         print('  len(words_tr): ', len(words_tr))
@@ -200,43 +265,44 @@ else:
 
     # Get doc indices
 
-    doc_indices_tr = create_doc_indices(docs_tr)
-    doc_indices_ts = create_doc_indices(docs_ts)
-    doc_indices_ts_h1 = create_doc_indices(docs_ts_h1)
-    doc_indices_ts_h2 = create_doc_indices(docs_ts_h2)
-    doc_indices_va = create_doc_indices(docs_va)
-
-    if args.verbosity>0:
-        print('  len(np.unique(doc_indices_tr)): {} [this should be {}]'.format(len(np.unique(doc_indices_tr)), len(docs_tr)))
-        print('  len(np.unique(doc_indices_ts)): {} [this should be {}]'.format(len(np.unique(doc_indices_ts)), len(docs_ts)))
-        print('  len(np.unique(doc_indices_ts_h1)): {} [this should be {}]'.format(len(np.unique(doc_indices_ts_h1)), len(docs_ts_h1)))
-        print('  len(np.unique(doc_indices_ts_h2)): {} [this should be {}]'.format(len(np.unique(doc_indices_ts_h2)), len(docs_ts_h2)))
-        print('  len(np.unique(doc_indices_va)): {} [this should be {}]'.format(len(np.unique(doc_indices_va)), len(docs_va)))
+    doc_indices_tr = bow_utils.create_doc_indices(lengths_tr)
+    doc_indices_ts = bow_utils.create_doc_indices(lengths_ts)
+    doc_indices_ts_h1 = bow_utils.create_doc_indices(lengths_ts_h1)
+    doc_indices_ts_h2 = bow_utils.create_doc_indices(lengths_ts_h2)
+    doc_indices_va = bow_utils.create_doc_indices(lengths_va)
 
     # Number of documents in each set
-    n_docs_tr = len(docs_tr)
-    n_docs_ts = len(docs_ts)
-    n_docs_ts_h1 = len(docs_ts_h1)
-    n_docs_ts_h2 = len(docs_ts_h2)
-    n_docs_va = len(docs_va)
+    n_docs_tr = len(lengths_tr)
+    n_docs_ts = len(lengths_ts)
+    n_docs_ts_h1 = len(lengths_ts_h1)
+    n_docs_ts_h2 = len(lengths_ts_h2)
+    n_docs_va = len(lengths_va)
 
-    # Remove unused variables
-    del docs_tr
-    del docs_ts
-    del docs_ts_h1
-    del docs_ts_h2
-    del docs_va
+    if args.verbosity>0:
+        print('  len(np.unique(doc_indices_tr)): {} [this should be {}]'.format(len(np.unique(doc_indices_tr)), n_docs_tr))
+        print('  len(np.unique(doc_indices_ts)): {} [this should be {}]'.format(len(np.unique(doc_indices_ts)), n_docs_ts))
+        print('  len(np.unique(doc_indices_ts_h1)): {} [this should be {}]'.format(len(np.unique(doc_indices_ts_h1)), n_docs_ts_h1))
+        print('  len(np.unique(doc_indices_ts_h2)): {} [this should be {}]'.format(len(np.unique(doc_indices_ts_h2)), n_docs_ts_h2))
+        print('  len(np.unique(doc_indices_va)): {} [this should be {}]'.format(len(np.unique(doc_indices_va)), n_docs_va))
 
     # Create bow representation
-    bow_tr = create_bow(doc_indices_tr, words_tr, n_docs_tr, len(vocab))
-    bow_ts = create_bow(doc_indices_ts, words_ts, n_docs_ts, len(vocab))
-    bow_ts_h1 = create_bow(doc_indices_ts_h1, words_ts_h1, n_docs_ts_h1, len(vocab))
-    bow_ts_h2 = create_bow(doc_indices_ts_h2, words_ts_h2, n_docs_ts_h2, len(vocab))
-    bow_va = create_bow(doc_indices_va, words_va, n_docs_va, len(vocab))
+    bow_tr = bow_utils.create_bow(doc_indices_tr, words_tr, n_docs_tr, len(vocab))
+    bow_ts = bow_utils.create_bow(doc_indices_ts, words_ts, n_docs_ts, len(vocab))
+    bow_ts_h1 = bow_utils.create_bow(doc_indices_ts_h1, words_ts_h1, n_docs_ts_h1, len(vocab))
+    bow_ts_h2 = bow_utils.create_bow(doc_indices_ts_h2, words_ts_h2, n_docs_ts_h2, len(vocab))
+    bow_va = bow_utils.create_bow(doc_indices_va, words_va, n_docs_va, len(vocab))
     if args.verbosity>0:
         ztime=int(time.time())
         print('Bow created in {} secs'.format(ztime-ytime))
 
+    # Collapse near-duplicates in train
+    weights_tr = None
+    if args.dedup>0:
+        bow_tr, weights_tr = bow_utils.collapse_duplicates(bow_tr, args.dedup)
+        if args.verbosity>0:
+            print(f'  near-duplicates collapsed: {n_docs_tr} training docs into {bow_tr.shape[0]}', file=sys.stderr)
+        n_docs_tr = bow_tr.shape[0]
+
     del words_tr
     del words_ts
     del words_ts_h1
@@ -251,46 +317,27 @@ else:
     # Save vocabulary to file
     with open(path_save + 'vocab.pkl', 'wb') as f:
         pickle.dump(vocab, f)
+    n_vocab = len(vocab)
     del vocab
 
-    # Split bow into token/value pairs
+    # Save bow splits
     if args.verbosity>0:
-        print('splitting bow into token/value pairs and saving to disk...')
+        print(f'saving bow splits to disk in the {args.format} format...')
 
-    bow_tr_tokens, bow_tr_counts = split_bow(bow_tr, n_docs_tr)
-    savemat(path_save + 'bow_tr_tokens.mat', {'tokens': bow_tr_tokens}, do_compression=True)
-    savemat(path_save + 'bow_tr_counts.mat', {'counts': bow_tr_counts}, do_compression=True)
+    shards = {}
+    shards['tr'] = [bow_utils.save_bow(path_save, 'bow_tr', bow_tr, args.format, weights_tr)]
     del bow_tr
-    del bow_tr_tokens
-    del bow_tr_counts
-
-    bow_va_tokens, bow_va_counts = split_bow(bow_va, n_docs_va)
-    savemat(path_save + 'bow_va_tokens.mat', {'tokens': bow_va_tokens}, do_compression=True)
-    savemat(path_save + 'bow_va_counts.mat', {'counts': bow_va_counts}, do_compression=True)
+    shards['va'] = [bow_utils.save_bow(path_save, 'bow_va', bow_va, args.format)]
     del bow_va
-    del bow_va_tokens
-    del bow_va_counts
-
-    bow_ts_tokens, bow_ts_counts = split_bow(bow_ts, n_docs_ts)
-    savemat(path_save + 'bow_ts_tokens.mat', {'tokens': bow_ts_tokens}, do_compression=True)
-    savemat(path_save + 'bow_ts_counts.mat', {'counts': bow_ts_counts}, do_compression=True)
+    shards['ts'] = [bow_utils.save_bow(path_save, 'bow_ts', bow_ts, args.format)]
     del bow_ts
-    del bow_ts_tokens
-    del bow_ts_counts
-
-    bow_ts_h1_tokens, bow_ts_h1_counts = split_bow(bow_ts_h1, n_docs_ts_h1)
-    savemat(path_save + 'bow_ts_h1_tokens.mat', {'tokens': bow_ts_h1_tokens}, do_compression=True)
-    savemat(path_save + 'bow_ts_h1_counts.mat', {'counts': bow_ts_h1_counts}, do_compression=True)
+    shards['ts_h1'] = [bow_utils.save_bow(path_save, 'bow_ts_h1', bow_ts_h1, args.format)]
     del bow_ts_h1
-    del bow_ts_h1_tokens
-    del bow_ts_h1_counts
-
-    bow_ts_h2_tokens, bow_ts_h2_counts = split_bow(bow_ts_h2, n_docs_ts_h2)
-    savemat(path_save + 'bow_ts_h2_tokens.mat', {'tokens': bow_ts_h2_tokens}, do_compression=True)
-    savemat(path_save + 'bow_ts_h2_counts.mat', {'counts': bow_ts_h2_counts}, do_compression=True)
+    shards['ts_h2'] = [bow_utils.save_bow(path_save, 'bow_ts_h2', bow_ts_h2, args.format)]
     del bow_ts_h2
-    del bow_ts_h2_tokens
-    del bow_ts_h2_counts
+    manifest = {'vocab_size': n_vocab, 'splits': shards}
+    bow_utils.add_source(manifest, corpus=args.corpusfile, num_docs=num_docs, docs={'tr': n_docs_tr, 'va': n_docs_va, 'ts': n_docs_ts})
+    bow_utils.write_manifest(path_save, manifest)
 
 if args.verbosity>0:
     print('Data ready !!')
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Converts a BoW dataset saved as compressed .mat cell arrays into memory-mapped .npy CSR arrays:
+#   python3 mat2npy.py DATADIR
+# Both legacy datasets (bow_tr_tokens.mat etc.) and sharded ones with manifest.json are accepted.
+
+import argparse
+import os
+import shutil
+import sys
+
+import bow_utils
+
+parser = argparse.ArgumentParser(description='Convert a .mat BoW dataset to the .npy format')
+parser.add_argument('data_path', type=str, help='directory with a BoW dataset')
+parser.add_argument('-o', '--output', type=str, help='directory for the converted dataset, the same one by default')
+parser.add_argument('--remove', default=False, action='store_true', help='remove the .mat files after conversion')
+parser.add_argument('-v', '--verbosity', type=int, default=1)
+args = parser.parse_args()
+
+path_save = args.output if args.output else args.data_path
+if not os.path.isdir(path_save):
+    os.makedirs(path_save)
+copy = not os.path.samefile(args.data_path, path_save)
+if os.path.isfile(os.path.join(args.data_path, 'vocab.pkl')) and copy:
+    shutil.copy(os.path.join(args.data_path, 'vocab.pkl'), path_save)
+
+manifest = bow_utils.dataset_manifest(args.data_path)
+
+for split, shards in manifest['splits'].items():
+    for i, shard in enumerate(shards):
+        if copy and 'weights' in shard: # the multiplicities of collapsed duplicates are always .npy
+            shutil.copy(os.path.join(args.data_path, f"{shard['file']}_weights.npy"), path_save)
+        if shard.get('format', 'mat') != 'mat':
+            if copy: # the shards already in the .npy format go to the new directory as they are
+                for key in ['indptr', 'indices', 'counts']:
+                    shutil.copy(os.path.join(args.data_path, f"{shard['file']}_{key}.npy"), path_save)
+            continue
+        bow = bow_utils.load_bow(args.data_path, shard, manifest['vocab_size'])
+        shards[i] = dict(shard, **bow_utils.save_bow(path_save, shard['file'], bow, 'npy'))
+        if args.remove:
+            for key in ['tokens', 'counts']:
+                os.remove(os.path.join(args.data_path, f"{shard['file']}_{key}.mat"))
+        if args.verbosity>0:
+            print(f"{shard['file']}: {bow.shape[0]} docs, {bow.nnz} entries", file=sys.stderr)
+
+bow_utils.write_manifest(path_save, manifest)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# The same rules as tokenise1.sh, so that data_new.py can tokenise the corpus while reading it (-t, -l):
+# the non-breakable space and tabs become proper spaces, html tags are removed, URLs are replaced with URLTAG,
+# punctuation and apostrophes are separated.
+# It can also be used as a filter:
+#   python3 tokenise.py -l <CORPUS.ol >CORPUS.ollc
+
+import re
+import sys
+
+SPACES = re.compile('[ \t]')
+TAGS = re.compile(r'</?[a-z":;, =-]+>')
+QUOTES = re.compile('[«»]')
+URLS = re.compile(r'https?:\S+')
+PUNCT = re.compile(r'([,.\[\]()/<>?!"%&^*:;]+)')
+MULTISPACE = re.compile(' +')
+
+
+def tokenise(line, lower=False):
+    line = SPACES.sub(' ', line)
+    line = TAGS.sub('', line)
+    line = QUOTES.sub(' " ', line)
+    line = URLS.sub(' URLTAG ', line)
+    line = PUNCT.sub(r' \1 ', line)
+    line = MULTISPACE.sub(' ', line)
+    line = line.replace("'", " ' ")
+    return line.lower() if lower else line
+
+
+def tokenise_lines(lines, tokenise_text=True, lower=False):
+    if tokenise_text:
+        return [tokenise(line, lower) for line in lines]
+    return [line.lower() for line in lines] if lower else lines
+
+
+if __name__ == '__main__':
+    lower = '-l' in sys.argv[1:]
+    sys.stdin.reconfigure(encoding='utf-8', errors='replace', newline='\n') # lines as in bow_utils.read_lines
+    for line in sys.stdin:
+        sys.stdout.write(tokenise(line, lower))
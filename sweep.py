@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Trains a grid of ETM configurations on the same dataset in a pool of processes and ranks them by TD*TC, e.g.:
+#   python3 sweep.py -b DATADIR --num_topics 10,25,50 --t_hidden_size 300,530 --lr 0.005,0.002 -e 20 -j 8
+# The dataset is loaded once before the workers are forked, so they share its memory.
+# Every --prune_every epochs only the --keep share of the configurations with the lowest
+# validation perplexity continue, the survivors are scored by topic diversity and coherence
+# (with --no_tc the coherence is taken as 1, so that they are ranked by diversity)
+
+import argparse
+import itertools
+import math
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from torch import optim
+
+import data
+from etm import ETM, save_bundle, load_bundle
+from utils import get_topic_coherence, get_topic_diversity
+
+parser = argparse.ArgumentParser(description='Hyperparameter sweep for the Embedded Topic Model')
+parser.add_argument('-b', '--data_path', type=str, default='data/20ng', help='directory containing BoW data')
+parser.add_argument('--dataset', type=str, default='20ng', help='dataset name')
+parser.add_argument('--save_path', type=str, default='./results', help='path to save the models')
+parser.add_argument('-o', '--output', type=str, default='-', help='the name of the file for the ranked table')
+parser.add_argument('-K', '--num_topics', type=str, default='10,25,50', help='comma-separated numbers of topics')
+parser.add_argument('--t_hidden_size', type=str, default='530', help='comma-separated dimensions of hidden space of q(theta)')
+parser.add_argument('--lr', type=str, default='0.005', help='comma-separated learning rates')
+parser.add_argument('-e', '--epochs', type=int, default=20, help='max number of epochs for each configuration')
+parser.add_argument('--prune_every', type=int, default=5, help='number of epochs between pruning by validation perplexity')
+parser.add_argument('--keep', type=float, default=0.5, help='share of the configurations which continue after each pruning')
+parser.add_argument('-j', '--workers', type=int, default=4, help='number of configurations trained at the same time')
+parser.add_argument('--batch_size', type=int, default=1000, help='input batch size for training')
+parser.add_argument('--eval_batch_size', type=int, default=1000, help='input batch size for evaluation')
+parser.add_argument('--rho_size', type=int, default=300, help='dimension of rho')
+parser.add_argument('--emb_size', type=int, default=300, help='dimension of embeddings')
+parser.add_argument('--theta_act', type=str, default='relu', help='tanh, softplus, relu, rrelu, leakyrelu, elu, selu, glu)')
+parser.add_argument('--enc_drop', type=float, default=0.0, help='dropout rate on encoder')
+parser.add_argument('--wdecay', type=float, default=1.2e-6, help='some l2 regularization')
+parser.add_argument('--bow_norm', type=int, default=1, help='normalize the bows or not')
+parser.add_argument('--no_tc', default=False, action='store_true', help='rank by topic diversity only, as topic coherence is time consuming')
+parser.add_argument('--seed', type=int, default=42, help='random seed')
+parser.add_argument('-v', '--verbosity', type=int, default=1)
+args = parser.parse_args()
+
+device = torch.device('cpu')
+
+# loaded once in the parent, the forked workers share these pages
+vocab, train, valid, test = data.get_data(args.data_path)
+
+
+def ckpt_name(K, H, lr):
+    return os.path.join(args.save_path, f'etm_{args.dataset}_K_{K}_Htheta_{H}_Lr_{lr}_RhoSize_{args.rho_size}')
+
+
+def doc_completion_ppl(m):
+    """Document completion perplexity as in the evaluate function of main.py."""
+    m.eval()
+    with torch.no_grad():
+        beta = m.get_beta()
+        indices = torch.split(torch.tensor(range(len(test['tokens_1']))), args.eval_batch_size)
+        batches_1 = data.BatchLoader(test['tokens_1'], test['counts_1'], indices, len(vocab), device, args.bow_norm, 0)
+        batches_2 = data.BatchLoader(test['tokens_2'], test['counts_2'], indices, len(vocab), device, args.bow_norm, 0)
+        acc_loss = 0
+        for (ind, _, normalized_data_batch_1), (_, data_batch_2, _) in zip(batches_1, batches_2):
+            theta, _ = m.get_theta(normalized_data_batch_1)
+            recon_loss = -(torch.log(torch.mm(theta, beta)) * data_batch_2).sum(1)
+            acc_loss += (recon_loss / data_batch_2.sum(1)).mean().item()
+    return math.exp(acc_loss / len(indices))
+
+
+def run(config, first_epoch, last_epoch):
+    """Trains a configuration from first_epoch to last_epoch, continuing from its saved state.
+    Returns the configuration with the best validation perplexity seen so far."""
+    K, H, lr = config
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.workers))
+    torch.manual_seed(args.seed)
+    ckpt = ckpt_name(K, H, lr)
+    model = ETM(K, len(vocab), H, args.rho_size, args.emb_size, args.theta_act, enc_drop=args.enc_drop).to(device)
+    optimizer = optim.Adam(model.parameters(), lr=lr, weight_decay=args.wdecay)
+    best_ppl = math.inf
+    if first_epoch > 1:
+        state = torch.load(ckpt + '.state', weights_only=True)
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        torch.set_rng_state(state['rng'])
+        best_ppl = state['best_ppl']
+    hyperparams = {'num_topics': K, 'vocab_size': len(vocab), 't_hidden_size': H, 'rho_size': args.rho_size,
+                   'emsize': args.emb_size, 'theta_act': args.theta_act, 'train_embeddings': True, 'enc_drop': args.enc_drop}
+    weights = train['weights']
+    if weights is not None:
+        weights = torch.from_numpy(weights.astype(np.float32))
+    for epoch in range(first_epoch, last_epoch+1):
+        model.train()
+        indices = torch.split(torch.randperm(len(train['tokens'])), args.batch_size)
+        for ind, data_batch, normalized_data_batch in data.BatchLoader(train['tokens'], train['counts'], indices,
+                                                                         len(vocab), device, args.bow_norm, 0):
+            optimizer.zero_grad()
+            recon_loss, kld_theta = model(data_batch, normalized_data_batch,
+                                              weights=None if weights is None else weights[ind])
+            (recon_loss + kld_theta).backward()
+            optimizer.step()
+        ppl = doc_completion_ppl(model)
+        if args.verbosity > 0:
+            print(f'K={K} H={H} lr={lr} epoch {epoch}: val PPL {round(ppl, 1)}', file=sys.stderr)
+        if ppl < best_ppl:
+            best_ppl = ppl
+            save_bundle(model, ckpt, hyperparams, vocab)
+    torch.save({'model': model.state_dict(), 'optimizer': optimizer.state_dict(),
+                    'rng': torch.get_rng_state(), 'best_ppl': best_ppl}, ckpt + '.state')
+    return config, best_ppl
+
+
+def score(config):
+    """Topic diversity and coherence of the best saved model of a configuration."""
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.workers))
+    beta = load_bundle(ckpt_name(*config))['beta'].numpy()
+    td = get_topic_diversity(beta, 25)
+    tc = 1.0 if args.no_tc else get_topic_coherence(beta, train['tokens'], vocab)
+    return config, td, tc
+
+
+if __name__ == '__main__':
+    starttime = time.time()
+    os.makedirs(args.save_path, exist_ok=True)
+    grid = list(itertools.product([int(x) for x in args.num_topics.split(',')],
+                                  [int(x) for x in args.t_hidden_size.split(',')],
+                                  [float(x) for x in args.lr.split(',')]))
+    alive = grid
+    results = {} # config -> (best val PPL, epochs trained)
+    with multiprocessing.get_context('fork').Pool(args.workers) as pool:
+        for first_epoch in range(1, args.epochs+1, args.prune_every):
+            last_epoch = min(first_epoch + args.prune_every - 1, args.epochs)
+            for config, ppl in pool.starmap(run, [(config, first_epoch, last_epoch) for config in alive]):
+                results[config] = (ppl, last_epoch)
+            if last_epoch < args.epochs:
+                alive = sorted(alive, key=lambda config: results[config][0])[:max(1, math.ceil(len(alive) * args.keep))]
+                if args.verbosity > 0:
+                    print(f'After epoch {last_epoch} continue with {alive}', file=sys.stderr)
+        scores = {config: (td, tc) for config, td, tc in pool.map(score, alive)}
+
+    outfile = open(args.output, 'w') if args.output != '-' else sys.stdout
+    print('K\tH\tlr\tepochs\tval_ppl\tTD\tTC\tTD*TC', file=outfile)
+    for config in sorted(alive, key=lambda config: -scores[config][0] * scores[config][1]):
+        td, tc = scores[config]
+        ppl, epochs = results[config]
+        tc = '-' if args.no_tc else round(tc, 4)
+        tdtc = '-' if args.no_tc else round(td*tc, 4)
+        print(f'{config[0]}\t{config[1]}\t{config[2]}\t{epochs}\t{round(ppl, 1)}\t{round(td, 4)}\t{tc}\t{tdtc}', file=outfile)
+    for config in sorted(set(grid) - set(alive), key=lambda config: results[config][0]): # pruned
+        ppl, epochs = results[config]
+        print(f'{config[0]}\t{config[1]}\t{config[2]}\t{epochs}\t{round(ppl, 1)}\t-\t-\t-', file=outfile)
+    if args.verbosity > 0:
+        print(f'Finished in {int(time.time()-starttime)} secs', file=sys.stderr)